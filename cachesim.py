@@ -0,0 +1,352 @@
+import sys
+
+import numpy as np
+
+# trace driven model of the Virtmem page cache (blocking mode) for policy and sizing studies
+# a trace is a sequence of word accesses (byte address, write flag), consecutive accesses to the same page
+# are collapsed into one reference with numpy, only the references are replayed one by one
+# the policy models follow the replacementpolicies modules of the same name as Virtmem drives them:
+# every word access is a hit for the policy, a miss first fills the victim and then hits it
+
+class LRUModel:
+	def __init__(self, npages):
+		self.order = list(range(npages)) # most recently used first
+
+	def victim(self):
+		return self.order[-1]
+
+	def fill(self, pg):
+		pass
+
+	def hit(self, pg, n):
+		self.order.remove(pg)
+		self.order.insert(0, pg)
+
+class PseudoLRUModel:
+	def __init__(self, npages):
+		self.nlevels = npages.bit_length() - 1
+		self.tree = [0]*npages
+
+	def victim(self):
+		node = 1
+		for l in range(self.nlevels):
+			node = 2*node + self.tree[node]
+		return node - 2**self.nlevels
+
+	def fill(self, pg):
+		pass
+
+	def hit(self, pg, n):
+		for l in range(self.nlevels):
+			self.tree[2**l + (pg >> (self.nlevels - l))] = 1 - ((pg >> (self.nlevels - 1 - l)) & 1)
+
+class RRIPModel:
+	def __init__(self, npages, rrpv_nbits=2, bimodal=False, brrip_throttle=32):
+		self.rrpv_max = 2**rrpv_nbits - 1
+		self.rrpv = [self.rrpv_max]*npages
+		self.bimodal = bimodal
+		self.brrip_throttle = brrip_throttle
+		self.fill_count = 0
+		self.last = 0
+
+	def victim(self):
+		return self.rrpv.index(max(self.rrpv))
+
+	def fill(self, pg):
+		age = self.rrpv_max - max(self.rrpv)
+		self.rrpv = [r + age for r in self.rrpv]
+		self.rrpv[pg] = self.rrpv_max if self.bimodal and self.fill_count != 0 else self.rrpv_max - 1
+		if self.bimodal:
+			self.fill_count = (self.fill_count + 1) % self.brrip_throttle
+		self.last = pg
+
+	def hit(self, pg, n):
+		if pg != self.last:
+			self.rrpv[pg] = 0
+		self.last = pg
+
+class TwoQModel:
+	def __init__(self, npages, kin=None):
+		self.npages = npages
+		self.kin = max(1, npages//4) if kin is None else kin
+		self.age = list(range(npages))
+		self.probation = [1]*npages
+		self.last = 0
+
+	def victim(self):
+		nprobation = sum(self.probation)
+		on_probation = 1 if nprobation > self.kin or nprobation == self.npages else 0
+		candidates = [i for i in range(self.npages) if self.probation[i] == on_probation]
+		return max(candidates, key=lambda i: self.age[i])
+
+	def touch(self, pg):
+		touched_age = self.age[pg]
+		self.age = [a + 1 if a < touched_age else a for a in self.age]
+		self.age[pg] = 0
+
+	def fill(self, pg):
+		self.touch(pg)
+		self.probation[pg] = 1
+		self.last = pg
+
+	def hit(self, pg, n):
+		if pg != self.last:
+			self.touch(pg)
+			self.probation[pg] = 0
+		self.last = pg
+
+class RoundRobinModel:
+	def __init__(self, npages):
+		self.npages = npages
+		self.next = 0
+
+	def victim(self):
+		return self.next
+
+	def fill(self, pg):
+		pass
+
+	def hit(self, pg, n):
+		self.next = (self.next + n) % self.npages
+
+policies = {
+	"truelru": LRUModel,
+	"pseudolru": PseudoLRUModel,
+	"counterlru": LRUModel,
+	"srrip": RRIPModel,
+	"brrip": lambda npages: RRIPModel(npages, bimodal=True),
+	"2q": TwoQModel,
+	"roundrobin": RoundRobinModel
+}
+
+# set dueling between two policies like replacementpolicies.SetDueling
+class SetDuelingModel:
+	def __init__(self, policy_a, policy_b, nsets, nways, psel_nbits=10):
+		self.psel_max = 2**psel_nbits - 1
+		self.psel = 2**(psel_nbits-1)
+		spacing = min(32, nsets)
+		self.leader = [0 if s % spacing == 0 else 1 if s % spacing == spacing - 1 else None for s in range(nsets)]
+		self.sets = [[policy_a(nways) if self.leader[s] != 1 else None, policy_b(nways) if self.leader[s] != 0 else None] for s in range(nsets)]
+
+	def victim(self, s):
+		a, b = self.sets[s]
+		if a is None or (b is not None and self.psel > self.psel_max//2):
+			return b.victim()
+		return a.victim()
+
+	def fill(self, s, pg):
+		if self.leader[s] == 0:
+			self.psel = min(self.psel + 1, self.psel_max)
+		elif self.leader[s] == 1:
+			self.psel = max(self.psel - 1, 0)
+		for policy in self.sets[s]:
+			if policy is not None:
+				policy.fill(pg)
+
+	def hit(self, s, pg, n):
+		for policy in self.sets[s]:
+			if policy is not None:
+				policy.hit(pg, n)
+
+class IndependentSets:
+	def __init__(self, policy, nsets, nways):
+		self.sets = [policy(nways) for s in range(nsets)]
+
+	def victim(self, s):
+		return self.sets[s].victim()
+
+	def fill(self, s, pg):
+		self.sets[s].fill(pg)
+
+	def hit(self, s, pg, n):
+		self.sets[s].hit(pg, n)
+
+def _log2(x):
+	assert(x > 0 and x & (x - 1) == 0)
+	return x.bit_length() - 1
+
+def _bit_masks(index, nbits):
+	# one bit per element as uint64 if it fits, as python ints otherwise
+	if nbits <= 64:
+		return np.left_shift(np.uint64(1), index.astype(np.uint64))
+	return np.array([1 << int(i) for i in index], dtype=object)
+
+def _popcount(x):
+	return bin(int(x)).count("1")
+
+def _runs(x):
+	# number of runs of consecutive ones
+	x = int(x)
+	return _popcount(x & ~(x << 1))
+
+# expand (start address, number of words, write) requests to word accesses
+def expand_requests(addrs, num_words, writes, wordsize=32):
+	addrs = np.asarray(addrs, dtype=np.uint64)
+	num_words = np.asarray(num_words, dtype=np.int64)
+	writes = np.asarray(writes, dtype=bool)
+	first = np.repeat(np.cumsum(num_words) - num_words, num_words)
+	offset = np.arange(first.size, dtype=np.int64) - first
+	return np.repeat(addrs, num_words) + (offset * (wordsize//8)).astype(np.uint64), np.repeat(writes, num_words)
+
+# trace files have one request per line: R|W address [num_words]
+def load_trace(filename, wordsize=32):
+	addrs, num_words, writes = [], [], []
+	with open(filename) as f:
+		for line in f:
+			fields = line.split()
+			if not fields or fields[0].startswith("#"):
+				continue
+			writes.append(fields[0].upper() == "W")
+			addrs.append(int(fields[1], 0))
+			num_words.append(int(fields[2], 0) if len(fields) > 2 else 1)
+	return expand_requests(addrs, num_words, writes, wordsize=wordsize)
+
+def save_trace(filename, requests):
+	with open(filename, "w") as f:
+		for addr, num_words, we in requests:
+			f.write("{} {:#x} {}\n".format("W" if we else "R", addr, num_words))
+
+class CacheModel:
+	def __init__(self, npagesincache=4, pagesize=4096, nways=None, replacement="truelru", replacement_duel=None, sectorsize=None, dirtysize=None, cmd_bytes=16):
+		# parameters as in Virtmem, cmd_bytes: size of a fetch or writeback command on the cmd channel
+		if nways is None:
+			nways = npagesincache
+		assert(npagesincache % nways == 0)
+		assert(replacement in policies)
+		assert(replacement_duel is None or replacement_duel in policies)
+		self.npagesincache = npagesincache
+		self.pagesize = pagesize
+		self.nways = nways
+		self.nsets = npagesincache//nways
+		self.sectorsize = pagesize if sectorsize is None else sectorsize
+		self.nsectors = pagesize//self.sectorsize
+		self.dirtysize = self.sectorsize if dirtysize is None else dirtysize
+		self.ndirty = pagesize//self.dirtysize
+		self.cmd_bytes = cmd_bytes
+
+		if replacement_duel is not None:
+			assert(self.nsets > 1 and nways > 1)
+			self.policy = SetDuelingModel(policies[replacement], policies[replacement_duel], self.nsets, nways)
+		else:
+			self.policy = IndependentSets(policies[replacement], self.nsets, nways)
+
+		self.tags = [[None]*nways for s in range(self.nsets)]
+		self.ways = {} # page -> way
+		self.sectors = [[0]*nways for s in range(self.nsets)]
+		self.dirty = [[0]*nways for s in range(self.nsets)]
+
+		self.accesses = 0
+		self.references = 0
+		self.page_misses = 0
+		self.sector_misses = 0
+		self.writebacks = 0
+		self.fetch_bytes = 0
+		self.writeback_bytes = 0
+		self.cmds = 0
+
+	def _writeback(self, s, w):
+		if not self.dirty[s][w]:
+			return
+		# writebacks send the dirty blocks (dirtysize defaults to sectorsize like in Virtmem) or the whole page, one command per range
+		if self.ndirty > 1:
+			blocks, blocksize = self.dirty[s][w], self.dirtysize
+		else:
+			blocks, blocksize = 1, self.pagesize
+		self.writebacks += 1
+		self.writeback_bytes += _popcount(blocks)*blocksize
+		self.cmds += _runs(blocks)
+		self.dirty[s][w] = 0
+
+	def run(self, addrs, writes=None):
+		addrs = np.asarray(addrs, dtype=np.uint64)
+		writes = np.zeros(addrs.size, dtype=bool) if writes is None else np.asarray(writes, dtype=bool)
+		if addrs.size == 0:
+			return self.stats()
+
+		page_bits = _log2(self.pagesize)
+		pages = addrs >> np.uint64(page_bits)
+		starts = np.flatnonzero(np.concatenate(([True], pages[1:] != pages[:-1])))
+		ref_pages = pages[starts]
+		ref_counts = np.diff(np.append(starts, addrs.size))
+		ref_writes = np.logical_or.reduceat(writes, starts)
+
+		offsets = addrs & np.uint64(self.pagesize - 1)
+		sector_masks = np.bitwise_or.reduceat(_bit_masks(offsets >> np.uint64(_log2(self.sectorsize)), self.nsectors), starts)
+		# first sector touched comes with the page miss
+		first_sectors = _bit_masks(offsets[starts] >> np.uint64(_log2(self.sectorsize)), self.nsectors)
+		if self.ndirty > 1:
+			dirty_bits = _bit_masks(offsets >> np.uint64(_log2(self.dirtysize)), self.ndirty)
+			dirty_bits = np.where(writes, dirty_bits, dirty_bits.dtype.type(0))
+			dirty_masks = np.bitwise_or.reduceat(dirty_bits, starts)
+		else:
+			dirty_masks = ref_writes
+
+		nsets = self.nsets
+		tags, ways, sectors, dirty, policy = self.tags, self.ways, self.sectors, self.dirty, self.policy
+		for page, count, sector_mask, first_sector, dirty_mask in zip(ref_pages.tolist(), ref_counts.tolist(), sector_masks.tolist(), first_sectors.tolist(), dirty_masks.tolist()):
+			s = page % nsets
+			w = ways.get(page)
+			if w is None:
+				w = policy.victim(s)
+				self._writeback(s, w)
+				ways.pop(tags[s][w], None)
+				ways[page] = w
+				tags[s][w] = page
+				sectors[s][w] = first_sector
+				dirty[s][w] = 0
+				self.page_misses += 1
+				self.fetch_bytes += self.sectorsize
+				self.cmds += 1
+				policy.fill(s, w)
+			missing = sector_mask & ~sectors[s][w]
+			if missing:
+				n = _popcount(missing)
+				self.sector_misses += n
+				self.fetch_bytes += n*self.sectorsize
+				self.cmds += n
+				sectors[s][w] |= missing
+			if dirty_mask:
+				dirty[s][w] |= int(dirty_mask)
+			policy.hit(s, w, count)
+
+		self.accesses += addrs.size
+		self.references += ref_pages.size
+		return self.stats()
+
+	# write back all dirty pages like a host flush
+	def flush(self):
+		for s in range(self.nsets):
+			for w in range(self.nways):
+				self._writeback(s, w)
+		return self.stats()
+
+	def stats(self):
+		misses = self.page_misses + self.sector_misses
+		return {
+			"accesses": self.accesses,
+			"references": self.references,
+			"page_misses": self.page_misses,
+			"sector_misses": self.sector_misses,
+			"hit_rate": 1 - misses/self.accesses if self.accesses else 0,
+			"writebacks": self.writebacks,
+			"fetch_bytes": self.fetch_bytes,
+			"writeback_bytes": self.writeback_bytes,
+			"pcie_bytes": self.fetch_bytes + self.writeback_bytes + self.cmds*self.cmd_bytes
+		}
+
+def main():
+	if len(sys.argv) < 2:
+		print("Usage: " + sys.argv[0] + " tracefile [parameter=value ...]")
+		return
+	kwargs = {}
+	for arg in sys.argv[2:]:
+		key, value = arg.split("=")
+		kwargs[key] = value if key.startswith("replacement") else int(value)
+	addrs, writes = load_trace(sys.argv[1])
+	m = CacheModel(**kwargs)
+	m.run(addrs, writes)
+	for key, value in m.flush().items():
+		print(key + ": " + str(value))
+
+if __name__ == '__main__':
+	main()
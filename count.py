@@ -7,10 +7,10 @@ import riffa, replacementpolicies
 from virtmem import VirtmemWrapper
 
 class Count(VirtmemWrapper):
-	def __init__(self, combined_interface_rx, combined_interface_tx, c_pci_data_width=32, wordsize=32, ptrsize=64, drive_clocks=True):
+	def __init__(self, combined_interface_rx, combined_interface_tx, c_pci_data_width=32, wordsize=32, ptrsize=64, drive_clocks=True, prefetch_depth=0, wide_write=False, write_nofetch=False):
 		# init the Virtual memory module superclass with the same data sizes
 		# drive_clocks: simulation does not support multiple clock regions
-		VirtmemWrapper.__init__(self, combined_interface_rx=combined_interface_rx, combined_interface_tx=combined_interface_tx, c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize, drive_clocks=drive_clocks)
+		VirtmemWrapper.__init__(self, combined_interface_rx=combined_interface_rx, combined_interface_tx=combined_interface_tx, c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize, drive_clocks=drive_clocks, prefetch_depth=prefetch_depth, wide_write=wide_write, write_nofetch=write_nofetch)
 
 		###
 
@@ -36,6 +36,15 @@ class Count(VirtmemWrapper):
 		self.comb += done.eq(res_struct >= num_words - 1)
 		last_read = Signal(wordsize)
 
+		# wide writes: each accepted word of the line gets the count of the words before it
+		line_words = c_pci_data_width//wordsize
+		wide_write = wide_write and line_words > 1
+		if wide_write:
+			ack_mask = self.virtmem.write_ack_mask
+			line_vals = [Signal(wordsize) for j in range(line_words)]
+			self.comb += [line_vals[j].eq(res_struct + sum(ack_mask[k] for k in range(j))) for j in range(line_words)]
+			self.comb += self.virtmem.data_write_line.eq(Cat(*line_vals)), self.virtmem.data_write_mask.eq(2**line_words - 1)
+
 		fsm = FSM()
 		self.submodules += fsm
 		fsm.act("IDLE", # wait for instruction to start calculating
@@ -68,6 +77,8 @@ class Count(VirtmemWrapper):
 			self.virtmem.write_enable.eq(1),
 			self.virtmem.data_write.eq(res_struct),
 			If(self.virtmem.write_ack,
+				NextValue(res_struct, res_struct + sum(ack_mask[k] for k in range(line_words)))
+				if wide_write else
 				NextValue(res_struct, res_struct + 1)
 			),
 			If(done,
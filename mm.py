@@ -7,8 +7,8 @@ import riffa, replacementpolicies
 from virtmem import VirtmemWrapper
 
 class MatMul(VirtmemWrapper):
-	def __init__(self, combined_interface_rx, combined_interface_tx, c_pci_data_width=32, wordsize=32, ptrsize=64, drive_clocks=True):
-		VirtmemWrapper.__init__(self, combined_interface_rx=combined_interface_rx, combined_interface_tx=combined_interface_tx, c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize, drive_clocks=drive_clocks)
+	def __init__(self, combined_interface_rx, combined_interface_tx, c_pci_data_width=32, wordsize=32, ptrsize=64, drive_clocks=True, nmshr=0, nstreams=0, stride_distance=2):
+		VirtmemWrapper.__init__(self, combined_interface_rx=combined_interface_rx, combined_interface_tx=combined_interface_tx, c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize, drive_clocks=drive_clocks, nmshr=nmshr, nstreams=nstreams, stride_distance=stride_distance)
 
 		###
 		rx, tx = self.get_channel(2)
@@ -43,6 +43,9 @@ class MatMul(VirtmemWrapper):
 		Cij = Signal(wordsize)
 		Aik0 = Signal(wordsize)
 		Bkj0 = Signal(wordsize)
+		# operand already read (with a non-blocking virtmem, B is requested while A is being fetched and vice versa)
+		A_ready = Signal()
+		B_ready = Signal()
 		Aik1 = Signal(wordsize)
 		Bkj1 = Signal(wordsize)
 		ires0 = Signal(wordsize)
@@ -130,39 +133,77 @@ class MatMul(VirtmemWrapper):
 
 		fsm.act("GET_A", #5
 			self.virtmem.virt_addr.eq(currA),
+			self.virtmem.stream_id.eq(0),
 			self.virtmem.req.eq(1),
 			self.virtmem.write_enable.eq(0),
 			If(self.virtmem.data_valid,
 				NextValue(Aik0, self.virtmem.data_read),
 				NextValue(currA, currA + incrA),
+				NextValue(A_ready, 1),
 				NextState("GET_A2")
+			).Elif(self.virtmem.done & self.virtmem.miss,
+				self.virtmem.req.eq(0),
+				If(~B_ready,
+					NextState("GET_B")
+				)
 			)
 		)
 		fsm.act("GET_A2",
 			If(self.virtmem.done,
-				NextState("GET_B")
+				If(B_ready,
+					NextValue(currB, currB + incrB),
+					NextValue(k, k + 1),
+					NextValue(A_ready, 0),
+					NextValue(B_ready, 0),
+					calc_enable_n.eq(1),
+					If(k < dim_k,
+						NextState("GET_A")
+					).Else(
+						last_in_n.eq(1),
+						NextState("WAIT_RES")
+					)
+				).Else(
+					NextState("GET_B")
+				)
 			)
 		)
 		fsm.act("GET_B", #6
 			self.virtmem.virt_addr.eq(currB),
+			self.virtmem.stream_id.eq(1), # column walk, stride dim_j words
 			self.virtmem.req.eq(1),
 			self.virtmem.write_enable.eq(0),
 			If(self.virtmem.data_valid,
 				NextValue(Bkj0, self.virtmem.data_read),
-				NextValue(currB, currB + incrB),
-				NextValue(k, k + 1),
-				calc_enable_n.eq(1),
-				If(k < dim_k,
-					NextState("GET_B2")
+				If(A_ready,
+					NextValue(currB, currB + incrB),
+					NextValue(k, k + 1),
+					NextValue(A_ready, 0),
+					calc_enable_n.eq(1),
+					If(k < dim_k,
+						NextState("GET_B2")
+					).Else(
+						last_in_n.eq(1),
+						NextState("WAIT_RES")
+					)
 				).Else(
-					last_in_n.eq(1),
-					NextState("WAIT_RES")
+					NextValue(B_ready, 1),
+					NextState("GET_B3")
+				)
+			).Elif(self.virtmem.done & self.virtmem.miss,
+				self.virtmem.req.eq(0),
+				If(~A_ready,
+					NextState("GET_A")
 				)
 			)
 		)
 		fsm.act("GET_B2",
 			NextState("GET_A")
 		)
+		fsm.act("GET_B3",
+			If(self.virtmem.done,
+				NextState("GET_A")
+			)
+		)
 
 		fsm.act("WAIT_RES", #7
 			NextValue(Aik0, 0),
@@ -175,14 +216,17 @@ class MatMul(VirtmemWrapper):
 		)
 		fsm.act("PUT_C", #8
 			self.virtmem.virt_addr.eq(currC),
+			self.virtmem.stream_id.eq(2),
 			self.virtmem.write_enable.eq(1),
 			self.virtmem.data_write.eq(Cij),
 			self.virtmem.req.eq(1),
 			If(self.virtmem.done,
 				self.virtmem.req.eq(0),
-				clear_Cij.eq(1),
-				NextValue(currC, currC + incrC),
-				NextState("ADVANCE_LOOP")
+				If(~self.virtmem.miss, # otherwise retry once the page is fetched
+					clear_Cij.eq(1),
+					NextValue(currC, currC + incrC),
+					NextState("ADVANCE_LOOP")
+				)
 			)
 		)
 		fsm.act("ADVANCE_LOOP", #9
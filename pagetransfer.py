@@ -2,6 +2,7 @@ import sys
 
 from migen.fhdl.std import *
 from migen.genlib.fsm import FSM, NextState, NextValue
+from migen.genlib.misc import optree
 
 from migen.sim.generic import run_simulation
 
@@ -11,7 +12,30 @@ import riffa
 from virtmem_tb import TBMemory
 
 class PageTransferrer(Module):
-	def __init__(self, rx0, tx0, rx1, tx1, rd_port, wr_port, c_pci_data_width=32, wordsize=32, ptrsize=64, npagesincache=4, pagesize=4096):
+	def __init__(self, rx0, tx0, rx1, tx1, rd_port, wr_port, c_pci_data_width=32, wordsize=32, ptrsize=64, npagesincache=4, pagesize=4096, sectorsize=None, wbsize=None, victim_buffer=False, nfetches=1, coalesce_flush=False, zero_pages=False, counters=False, push=False):
+		# sectorsize: fetch granularity, fetches bring in the sector containing virt_addr (None = whole pages)
+		# wbsize: writeback granularity, writebacks send the blocks selected by wb_mask,
+		#   each run of consecutive blocks as one range (None = sectorsize)
+		# victim_buffer: send_req copies the page to a victim buffer and completes once the copy has started,
+		#   the writeback is sent from the buffer in the background (wb_busy) while following fetches proceed
+		#   rd_port and wr_port must be separate ports, rd_port is in use while copy_busy
+		# nfetches: number of page fetches in flight, with nfetches > 1 fetch_req completes once the fetch command has been sent
+		#   and the page is received in the background, in the order of the requests: fetch_done is raised for one cycle
+		#   with fetch_page_addr once it has been written to the cache, fetch_busy while fetches are in flight
+		#   a send_req waits until all pages have been received
+		# coalesce_flush: flush_req writes back all pages selected by flush_mask in a single data transaction,
+		#   a header with one 64 bit entry per cache page (its address from flush_tags, or all ones if it is not selected)
+		#   followed by the selected pages in order, and a single command [number of entries, number of pages, 0x61B0A110, 0x61B0A110]
+		#   (the header is padded with all ones entries to a multiple of c_pci_data_width)
+		#   (only for whole page writebacks without victim buffer)
+		# zero_pages: the host may answer a fetch with a single word instead of the data when the page (or sector) is all zeros,
+		#   it is then cleared here; written back ranges are checked first and an all zero range is only announced
+		#   by a writeback command with 0x2E8061B0 instead of 0x61B061B0 and the length in 32 bit words, without data
+		# pagesize: pages other than 4 KiB (huge pages) are fetched and written back in a single transaction each,
+		#   with commands that carry the length like sector commands, so the host does not need to know the page size
+		# counters: count fetches, writebacks, 32 bit words received and sent, and cycles spent waiting for the host to send a page
+		# push: push_req receives a page the host sends without a fetch command into page_addr,
+		#   with push_discard it is received but not written (only with nfetches == 1)
 
 		self.cmd_rx = rx0
 		self.cmd_tx = tx0
@@ -26,6 +50,31 @@ class PageTransferrer(Module):
 		self.send_req = Signal()
 		self.fetch_req = Signal()
 		self.req_complete = Signal()
+		self.wb_busy = Signal()
+		self.copy_busy = Signal()
+		self.fetch_done = Signal()
+		self.fetch_page_addr = Signal(log2_int(npagesincache))
+		self.fetch_busy = Signal()
+		self.flush_req = Signal()
+		self.flush_mask = Signal(npagesincache)
+		self.push_req = Signal()
+		self.push_discard = Signal()
+		self.fetches = Signal(32)
+		self.writebacks = Signal(32)
+		self.words_received = Signal(32)
+		self.words_sent = Signal(32)
+		self.host_wait_cycles = Signal(32)
+
+		if sectorsize is None:
+			sectorsize = pagesize
+		assert(pagesize % sectorsize == 0)
+		nsectors = pagesize//sectorsize
+		if wbsize is None:
+			wbsize = sectorsize
+		assert(pagesize % wbsize == 0)
+		nwbblocks = pagesize//wbsize
+
+		self.wb_mask = Signal(nwbblocks)
 
 		##
 
@@ -67,6 +116,26 @@ class PageTransferrer(Module):
 
 		page_tag_nbits = ptrsize - page_tag_off
 
+		assert(sectorsize*8 >= memorywidth)
+		sector_words = sectorsize//4
+		sector_off = log2_int(sectorsize)
+		sector_nbits = log2_int(nsectors)
+		sector_line_nbits = line_adr_nbits - sector_nbits
+
+		assert(wbsize*8 >= memorywidth)
+		wb_off = log2_int(wbsize)
+		wb_line_nbits = log2_int(wbsize*8//memorywidth)
+
+		assert(nfetches >= 1)
+		assert(nfetches == 1 or not victim_buffer)
+		assert(not coalesce_flush or (nwbblocks == 1 and not victim_buffer))
+		assert(not push or nfetches == 1)
+
+		self.flush_tags = Signal(npagesincache*page_tag_nbits)
+
+		# writebacks start with the zero check
+		tx_start_state = "TX_ZERO_CHECK" if zero_pages else "TX_DIRTY_PAGE_INIT"
+
 		# variables
 
 		virt_addr_internal = Signal(ptrsize)
@@ -77,81 +146,418 @@ class PageTransferrer(Module):
 		wordcount = Signal(32)
 		rlen = Signal(32)
 
+		# sector being fetched
+		sector = Signal(max=max(2, nsectors))
+
+		# the page being received is not written
+		rx_discard = Signal()
+
+		# page being written back
+		wb_virt_addr = Signal(ptrsize)
+		wb_page_addr = Signal(max=max(2, npagesincache))
+
+		# pages selected for a coalesced flush, pages still to send
+		flush_sel = Signal(npagesincache)
+		flush_left = Signal(npagesincache)
+		flush_npages = Signal(max=npagesincache+1)
+
+		# blocks still to write back, range being written back
+		wb_left = Signal(nwbblocks)
+		wb_start = Signal(max=nwbblocks+1)
+		wb_words = Signal(32)
+
+		# with a victim buffer the request waits here until the buffer is free
+		if victim_buffer:
+			req_wb_virt_addr = Signal(ptrsize)
+			req_wb_page_addr = Signal(max=max(2, npagesincache))
+			req_wb_left = Signal(nwbblocks)
+		else:
+			req_wb_virt_addr, req_wb_page_addr, req_wb_left = wb_virt_addr, wb_page_addr, wb_left
+
 		# state machine that controls page cache
 		fsm = FSM()
 		self.submodules += fsm
 
-		fsm.act("IDLE", #0
-			#reset internal registers
-			NextValue(rxcount, 0),
-			NextValue(txcount, 0),
-			NextValue(wordcount, 0),
-			NextValue(rlen, 0),
-			self.req_complete.eq(1),
-			If(self.send_req,
-				NextValue(virt_addr_internal, self.virt_addr),
-				NextValue(page_addr_internal, self.page_addr),
-				NextState("TX_DIRTY_PAGE_INIT")
-			).Elif(self.fetch_req,
+		if nfetches > 1:
+			# fetches whose command has been sent, received in order by rx_fsm
+			fetch_queue_page_addr = Array(Signal(page_adr_nbits, name="fetch_queue_page_addr") for i in range(nfetches))
+			fetch_queue_sector = Array(Signal(max=max(2, nsectors), name="fetch_queue_sector") for i in range(nfetches))
+			fetch_queue_head = Signal(max=nfetches)
+			fetch_queue_tail = Signal(max=nfetches)
+			fetch_queue_count = Signal(max=nfetches+1)
+			fetch_queue_push = Signal()
+			fetch_queue_pop = Signal()
+
+			self.sync += If(fetch_queue_push,
+				fetch_queue_page_addr[fetch_queue_tail].eq(page_addr_internal),
+				fetch_queue_sector[fetch_queue_tail].eq(sector),
+				fetch_queue_tail.eq(Mux(fetch_queue_tail == nfetches - 1, 0, fetch_queue_tail + 1))
+			)
+			self.sync += If(fetch_queue_pop,
+				fetch_queue_head.eq(Mux(fetch_queue_head == nfetches - 1, 0, fetch_queue_head + 1))
+			)
+			self.sync += fetch_queue_count.eq(fetch_queue_count + fetch_queue_push - fetch_queue_pop)
+			self.comb += self.fetch_busy.eq(fetch_queue_count != 0)
+
+			rx_fsm = FSM()
+			self.submodules += rx_fsm
+			rx_page_addr = fetch_queue_page_addr[fetch_queue_head]
+			rx_sector = fetch_queue_sector[fetch_queue_head]
+			self.comb += self.fetch_page_addr.eq(rx_page_addr)
+		else:
+			rx_fsm = fsm
+			rx_page_addr = page_addr_internal
+			rx_sector = sector
+
+		def rx_line_adr(count):
+			return [
+				wr_port.adr[0:sector_line_nbits].eq(count[pcie_word_adr_nbits:pcie_word_adr_nbits + sector_line_nbits]),
+				wr_port.adr[sector_line_nbits:line_adr_nbits].eq(rx_sector) if nsectors > 1 else [],
+				wr_port.adr[-page_adr_nbits:].eq(rx_page_addr)
+			]
+
+		if victim_buffer:
+			# the writeback is sent from the victim buffer by its own state machine
+			self.specials.vb = Memory(memorywidth, pagesize*8//memorywidth)
+			self.specials.vb_rd_port = tx_port = self.vb.get_port(has_re=True)
+			self.specials.vb_wr_port = vb_wr_port = self.vb.get_port(write_capable=True)
+			tx_fsm = FSM()
+			self.submodules += tx_fsm
+			tx_done_state = "IDLE"
+		else:
+			tx_port = rd_port
+			tx_fsm = fsm
+			tx_done_state = "REQ_COMPLETE"
+
+		def tx_line_adr(count):
+			return [
+				tx_port.adr[0:line_adr_nbits].eq((wb_start << wb_line_nbits) + count[pcie_word_adr_nbits:pcie_word_adr_nbits + line_adr_nbits])
+				if nwbblocks > 1 else
+				tx_port.adr[0:line_adr_nbits].eq(count[pcie_word_adr_nbits:pcie_word_adr_nbits + line_adr_nbits]),
+				tx_port.adr[-page_adr_nbits:].eq(wb_page_addr) if not victim_buffer else []
+			]
+
+		idle_req = If(self.send_req,
+			NextValue(req_wb_virt_addr, self.virt_addr),
+			NextValue(req_wb_page_addr, self.page_addr),
+			NextValue(req_wb_left, self.wb_mask) if nwbblocks > 1 else [],
+			NextState("VICTIM_COPY_INIT") if victim_buffer else
+			NextState("TX_WAIT_FETCHES") if nfetches > 1 else
+			NextState("TX_NEXT_RANGE") if nwbblocks > 1 else NextState(tx_start_state)
+		).Elif(self.fetch_req,
+			NextValue(virt_addr_internal, self.virt_addr),
+			NextValue(page_addr_internal, self.page_addr),
+			NextValue(sector, self.virt_addr[sector_off:page_tag_off]) if nsectors > 1 else [],
+			NextValue(rx_discard, 0) if push else [],
+			NextState("TX_PAGE_FETCH_CMD")
+		)
+		if coalesce_flush:
+			idle_req.Elif(self.flush_req,
+				NextValue(flush_sel, self.flush_mask),
+				NextValue(flush_left, self.flush_mask),
+				NextValue(flush_npages, optree("+", [self.flush_mask[i] for i in range(npagesincache)])),
+				NextState("TX_FLUSH_INIT")
+			)
+		if push:
+			# the host has already announced the page, wait for its data
+			idle_req.Elif(self.push_req,
 				NextValue(virt_addr_internal, self.virt_addr),
 				NextValue(page_addr_internal, self.page_addr),
-				NextState("TX_PAGE_FETCH_CMD")
+				NextValue(sector, 0) if nsectors > 1 else [],
+				NextValue(rx_discard, self.push_discard),
+				NextState("RX_WAIT")
 			)
+		fsm.act("IDLE", #0
+			#reset internal registers
+			[NextValue(rxcount, 0), NextValue(rlen, 0)] if nfetches == 1 else [],
+			self.req_complete.eq(1),
+			idle_req
 		)
 
+		# fetches complete only after the page has been copied out, rd_port belongs to the cache again afterwards
+		copying = self.copy_busy
 		fsm.act("REQ_COMPLETE",
-			self.req_complete.eq(1),
-			NextState("IDLE")
+			If(~copying,
+				self.req_complete.eq(1),
+				NextState("IDLE")
+			)
 		)
 
+		# victim copy: one line per cycle from the cache to the victim buffer, ahead of the fetch into the same page
+		rx_ok = Signal()
+		if victim_buffer:
+			copy_line = Signal(max=pagesize*8//memorywidth+1)
+			copy_we = Signal()
+			copy_start = Signal()
+			self.comb += copy_start.eq(fsm.ongoing("VICTIM_COPY_INIT") & ~self.wb_busy)
+			fsm.act("VICTIM_COPY_INIT", # wait for the previous writeback to leave the buffer
+				If(~self.wb_busy,
+					NextState("IDLE")
+				)
+			)
+			self.sync += If(copy_start,
+					copying.eq(1),
+					copy_line.eq(0),
+					self.wb_busy.eq(1),
+					wb_virt_addr.eq(req_wb_virt_addr),
+					wb_page_addr.eq(req_wb_page_addr),
+					wb_left.eq(req_wb_left)
+				).Elif(copying,
+					copy_line.eq(copy_line + 1),
+					If(copy_line == pagesize*8//memorywidth - 1,
+						copying.eq(0)
+					)
+				).Elif(tx_fsm.before_entering("IDLE"),
+					self.wb_busy.eq(0)
+				)
+			self.comb += If(copying,
+					rd_port.adr[0:line_adr_nbits].eq(copy_line),
+					rd_port.adr[-page_adr_nbits:].eq(wb_page_addr),
+					rd_port.re.eq(1)
+				)
+			self.sync += copy_we.eq(copying), vb_wr_port.adr.eq(copy_line)
+			self.comb += vb_wr_port.dat_w.eq(rd_port.dat_r), vb_wr_port.we.eq(copy_we)
+			# lines of the victim page are only overwritten once copied
+			rx_line = Signal(line_adr_nbits)
+			self.comb += rx_line[0:sector_line_nbits].eq(rxcount[pcie_word_adr_nbits:pcie_word_adr_nbits + sector_line_nbits])
+			if nsectors > 1:
+				self.comb += rx_line[sector_line_nbits:].eq(sector)
+			self.comb += rx_ok.eq(~copying | (page_addr_internal != wb_page_addr) | (rx_line < copy_line))
+
+			tx_fsm.act("IDLE",
+				If(self.wb_busy & ~copying,
+					NextState("TX_NEXT_RANGE") if nwbblocks > 1 else NextState(tx_start_state)
+				)
+			)
+		else:
+			self.comb += rx_ok.eq(1)
+
 		# page send
 
-		fsm.act("TX_DIRTY_PAGE_INIT", #4
+		if nfetches > 1:
+			# rd_port may share the cache port written by rx_fsm
+			fsm.act("TX_WAIT_FETCHES",
+				If(~self.fetch_busy,
+					NextState("TX_NEXT_RANGE") if nwbblocks > 1 else NextState(tx_start_state)
+				)
+			)
+
+		if nwbblocks > 1:
+			# send the lowest run of selected blocks, followed by its writeback command, until none are left
+			# adding the lowest set bit clears the run and sets the bit after its end
+			wb_lowbit = Signal(nwbblocks)
+			wb_carry = Signal(nwbblocks+1)
+			next_wb_start = Signal(max=nwbblocks+1)
+			next_wb_end = Signal(max=nwbblocks+1)
+			self.comb += wb_lowbit.eq(wb_left & (~wb_left + 1)), wb_carry.eq(wb_left + wb_lowbit)
+			self.comb += [If(wb_left[i], next_wb_start.eq(i)) for i in reversed(range(nwbblocks))]
+			self.comb += [If(wb_carry[i], next_wb_end.eq(i)) for i in reversed(range(nwbblocks+1))]
+			tx_fsm.act("TX_NEXT_RANGE",
+				If(wb_left == 0,
+					NextState(tx_done_state)
+				).Else(
+					NextValue(wb_start, next_wb_start),
+					NextValue(wb_words, (next_wb_end - next_wb_start) << (wb_off - 2)),
+					NextValue(wb_left, wb_left & wb_carry),
+					NextState(tx_start_state)
+				)
+			)
+
+		wb_len = wb_words if nwbblocks > 1 else pagesize//4
+		wb_zero = Signal()
+		if zero_pages:
+			# read the range line by line, send it as soon as a line is not zero
+			tx_fsm.act("TX_ZERO_CHECK",
+				NextValue(wb_zero, 0),
+				tx_line_adr(C(0, 32)),
+				tx_port.re.eq(1),
+				NextValue(txcount, memorywidth//32),
+				NextState("TX_ZERO_CHECK_LINE")
+			)
+			tx_fsm.act("TX_ZERO_CHECK_LINE",
+				If(tx_port.dat_r != 0,
+					NextState("TX_DIRTY_PAGE_INIT")
+				).Elif(txcount >= wb_len,
+					NextValue(wb_zero, 1),
+					NextState("TX_WRITEBACK_CMD")
+				).Else(
+					tx_line_adr(txcount),
+					tx_port.re.eq(1),
+					NextValue(txcount, txcount + memorywidth//32)
+				)
+			)
+
+		tx_fsm.act("TX_DIRTY_PAGE_INIT", #4
 			self.data_tx.start.eq(1),
-			self.data_tx.len.eq(pagesize//4),
+			self.data_tx.len.eq(wb_words if nwbblocks > 1 else pagesize//4),
 			self.data_tx.last.eq(1),
 			NextValue(txcount, c_pci_data_width//32),
 			NextValue(wordcount, 0),
 			If(self.data_tx.ack,
-				rd_port.adr.eq(0),
-				rd_port.adr[-page_adr_nbits:].eq(page_addr_internal),
-				rd_port.re.eq(1),
+				tx_line_adr(C(0, 32)),
+				tx_port.re.eq(1),
 				NextState("TX_DIRTY_PAGE")
 			)
 		)
-		fsm.act("TX_DIRTY_PAGE", #5
+		tx_fsm.act("TX_DIRTY_PAGE", #5
 			self.data_tx.start.eq(1),
-			self.data_tx.len.eq(pagesize//4),
+			self.data_tx.len.eq(wb_words if nwbblocks > 1 else pagesize//4),
 			self.data_tx.last.eq(1),
 			self.data_tx.data_valid.eq(1),
-			self.data_tx.data.eq(rd_port.dat_r)
+			self.data_tx.data.eq(tx_port.dat_r)
 			if c_pci_data_width >= wordsize else
-			[If(i == wordcount[:word_adr_nbits], self.data_tx.data.eq(rd_port.dat_r[i*c_pci_data_width:(i+1)*c_pci_data_width])) for i in range(num_tx_per_word)],
+			[If(i == wordcount[:word_adr_nbits], self.data_tx.data.eq(tx_port.dat_r[i*c_pci_data_width:(i+1)*c_pci_data_width])) for i in range(num_tx_per_word)],
 			If(self.data_tx.data_ren,
 				NextValue(txcount, txcount + c_pci_data_width//32),
 				NextValue(wordcount, wordcount + 1),
-				If(txcount < (pagesize//4),
-					rd_port.adr[0: line_adr_nbits].eq(txcount[pcie_word_adr_nbits:pcie_word_adr_nbits + line_adr_nbits]),
-					rd_port.adr[-page_adr_nbits:].eq(page_addr_internal),
-					rd_port.re.eq(1)
+				If(txcount < (wb_words if nwbblocks > 1 else pagesize//4),
+					tx_line_adr(txcount),
+					tx_port.re.eq(1)
 				).Else(
 					NextState("TX_WRITEBACK_CMD")
 				)
 			)
 		)
 
+		if coalesce_flush:
+			# header, then the pages in order, and the writeback command
+			# the header is padded with all ones entries to whole beats when the cache has fewer pages than a beat has entries
+			flush_header_beats = (npagesincache*64 + c_pci_data_width - 1)//c_pci_data_width
+			flush_entries = flush_header_beats*c_pci_data_width//64
+			flush_header = Signal(flush_entries*64)
+			self.comb += flush_header.eq(Cat(*[Mux(flush_sel[i], Cat(C(0, page_tag_off), self.flush_tags[i*page_tag_nbits:(i+1)*page_tag_nbits]), C(2**64 - 1, 64)) for i in range(npagesincache)] + [C(2**64 - 1, 64)]*(flush_entries - npagesincache)))
+			flush_beat = Signal(max=max(2, flush_header_beats))
+			flush_len = Signal(32)
+			flush_next = Signal(page_adr_nbits)
+			self.comb += flush_len.eq(flush_entries*2 + flush_npages*(pagesize//4))
+			self.comb += [If(flush_left[i], flush_next.eq(i)) for i in reversed(range(npagesincache))]
+
+			# start reading the next page and take it off the list
+			def flush_next_page():
+				return [
+					NextValue(wb_page_addr, flush_next),
+					NextValue(flush_left, flush_left & ~(1 << flush_next)),
+					NextValue(txcount, c_pci_data_width//32),
+					NextValue(wordcount, 0),
+					tx_port.adr[0:line_adr_nbits].eq(0),
+					tx_port.adr[-page_adr_nbits:].eq(flush_next),
+					tx_port.re.eq(1),
+					NextState("TX_FLUSH_PAGE")
+				]
+
+			fsm.act("TX_FLUSH_INIT",
+				self.data_tx.start.eq(1),
+				self.data_tx.len.eq(flush_len),
+				self.data_tx.last.eq(1),
+				NextValue(flush_beat, 0),
+				If(self.data_tx.ack,
+					NextState("TX_FLUSH_HEADER")
+				)
+			)
+			fsm.act("TX_FLUSH_HEADER",
+				self.data_tx.start.eq(1),
+				self.data_tx.len.eq(flush_len),
+				self.data_tx.last.eq(1),
+				self.data_tx.data_valid.eq(1),
+				self.data_tx.data.eq(Array(flush_header[i*c_pci_data_width:(i+1)*c_pci_data_width] for i in range(flush_header_beats))[flush_beat]),
+				If(self.data_tx.data_ren,
+					NextValue(flush_beat, flush_beat + 1),
+					If(flush_beat == flush_header_beats - 1,
+						If(flush_left == 0,
+							NextState("TX_FLUSH_CMD")
+						).Else(
+							flush_next_page()
+						)
+					)
+				)
+			)
+			fsm.act("TX_FLUSH_PAGE",
+				self.data_tx.start.eq(1),
+				self.data_tx.len.eq(flush_len),
+				self.data_tx.last.eq(1),
+				self.data_tx.data_valid.eq(1),
+				self.data_tx.data.eq(tx_port.dat_r)
+				if c_pci_data_width >= wordsize else
+				[If(i == wordcount[:word_adr_nbits], self.data_tx.data.eq(tx_port.dat_r[i*c_pci_data_width:(i+1)*c_pci_data_width])) for i in range(num_tx_per_word)],
+				If(self.data_tx.data_ren,
+					NextValue(txcount, txcount + c_pci_data_width//32),
+					NextValue(wordcount, wordcount + 1),
+					If(txcount < pagesize//4,
+						tx_line_adr(txcount),
+						tx_port.re.eq(1)
+					).Elif(flush_left != 0,
+						flush_next_page()
+					).Else(
+						NextState("TX_FLUSH_CMD")
+					)
+				)
+			)
+
+			flush_cmd = Signal(128)
+			self.comb += flush_cmd[0:32].eq(flush_entries), flush_cmd[32:64].eq(flush_npages), flush_cmd[64:128].eq(0x61B0A11061B0A110)
+			fsm.act("TX_FLUSH_CMD",
+				self.cmd_tx.start.eq(1),
+				self.cmd_tx.len.eq(4),
+				self.cmd_tx.last.eq(1),
+				If(self.cmd_tx.ack,
+					NextState("TX_FLUSH_CMD0")
+				)
+			)
+			for i in range(128//c_pci_data_width):
+				fsm.act("TX_FLUSH_CMD" + str(i),
+					self.cmd_tx.start.eq(1),
+					self.cmd_tx.len.eq(4),
+					self.cmd_tx.last.eq(1),
+					self.cmd_tx.data.eq(flush_cmd[i*c_pci_data_width:(i+1)*c_pci_data_width]),
+					self.cmd_tx.data_valid.eq(1),
+					If(self.cmd_tx.data_ren,
+						NextState("TX_FLUSH_CMD" + str(i+1)) if i+1 < 128//c_pci_data_width else NextState("REQ_COMPLETE")
+					)
+				)
+
+		# sector and range commands carry the byte offset in the address and the length (in 32 bit words) in the upper half of the magic
 		page_writeback_cmd = Signal(128)
-		self.comb += page_writeback_cmd[64:128].eq(0x61B061B061B061B0), page_writeback_cmd[page_tag_off:64].eq(virt_addr_internal[page_tag_off:64])
-		fsm.act("TX_WRITEBACK_CMD", #2
-			self.cmd_tx.start.eq(1),
-			self.cmd_tx.len.eq(4),
-			self.cmd_tx.last.eq(1),
-			If(self.cmd_tx.ack,
-				NextState("TX_WRITEBACK_CMD0")
+		if nwbblocks > 1:
+			self.comb += page_writeback_cmd[96:128].eq(wb_words), page_writeback_cmd[64:96].eq(0x61B061B0), page_writeback_cmd[page_tag_off:64].eq(wb_virt_addr[page_tag_off:64]), page_writeback_cmd[wb_off:page_tag_off].eq(wb_start)
+		elif pagesize != 4096:
+			self.comb += page_writeback_cmd[96:128].eq(pagesize//4), page_writeback_cmd[64:96].eq(0x61B061B0), page_writeback_cmd[page_tag_off:64].eq(wb_virt_addr[page_tag_off:64])
+		else:
+			self.comb += page_writeback_cmd[64:128].eq(0x61B061B061B061B0), page_writeback_cmd[page_tag_off:64].eq(wb_virt_addr[page_tag_off:64])
+		if zero_pages:
+			self.comb += If(wb_zero, page_writeback_cmd[64:96].eq(0x2E8061B0), page_writeback_cmd[96:128].eq(wb_len))
+
+		# with a victim buffer, writeback and fetch commands share cmd_tx: a writeback command is only started
+		# while no fetch command is being sent, and a fetch command waits while the writeback command holds the channel
+		wb_cmd_grant = Signal()
+		fetch_cmd_ok = Signal()
+		if victim_buffer:
+			fetch_cmd_active = Signal()
+			wb_cmd_states = ["TX_WRITEBACK_CMD"] + ["TX_WRITEBACK_CMD" + str(i) for i in range(128//c_pci_data_width)]
+			self.comb += fetch_cmd_active.eq((fsm.ongoing("TX_PAGE_FETCH_CMD") & fetch_cmd_ok) | optree("|", [fsm.ongoing("TX_PAGE_FETCH_CMD" + str(i)) for i in range(128//c_pci_data_width)]))
+			self.sync += If(~optree("|", [tx_fsm.ongoing(state) for state in wb_cmd_states]),
+					wb_cmd_grant.eq(0)
+				).Elif(~fetch_cmd_active,
+					wb_cmd_grant.eq(1)
+				)
+			# the host must see the writeback of a page before fetching it again
+			self.comb += fetch_cmd_ok.eq(~wb_cmd_grant & ~(self.wb_busy & (wb_virt_addr[page_tag_off:] == virt_addr_internal[page_tag_off:])))
+		elif nfetches > 1:
+			self.comb += wb_cmd_grant.eq(1), fetch_cmd_ok.eq(fetch_queue_count != nfetches)
+		else:
+			self.comb += wb_cmd_grant.eq(1), fetch_cmd_ok.eq(1)
+
+		tx_fsm.act("TX_WRITEBACK_CMD", #2
+			If(wb_cmd_grant,
+				self.cmd_tx.start.eq(1),
+				self.cmd_tx.len.eq(4),
+				self.cmd_tx.last.eq(1),
+				If(self.cmd_tx.ack,
+					NextState("TX_WRITEBACK_CMD0")
+				)
 			)
 		)
 		for i in range(128//c_pci_data_width):
-			fsm.act("TX_WRITEBACK_CMD" + str(i), #3
+			tx_fsm.act("TX_WRITEBACK_CMD" + str(i), #3
 				self.cmd_tx.start.eq(1),
 				self.cmd_tx.len.eq(4),
 				self.cmd_tx.last.eq(1),
@@ -160,7 +566,7 @@ class PageTransferrer(Module):
 				If(self.cmd_tx.data_ren,
 					NextState("TX_WRITEBACK_CMD" + str(i+1)) 
 					if i+1 < 128//c_pci_data_width else 
-					NextState("REQ_COMPLETE")
+					NextState("TX_NEXT_RANGE") if nwbblocks > 1 else NextState(tx_done_state)
 				)
 			)
 
@@ -168,13 +574,18 @@ class PageTransferrer(Module):
 		# page fetch
 
 		page_fetch_cmd = Signal(128)
-		self.comb += page_fetch_cmd[64: 128].eq(0x6E706E706E706E70), page_fetch_cmd[page_tag_off: 64].eq(virt_addr_internal[page_tag_off:])
+		if nsectors > 1 or pagesize != 4096:
+			self.comb += page_fetch_cmd[96:128].eq(sector_words), page_fetch_cmd[64:96].eq(0x6E706E70), page_fetch_cmd[sector_off:64].eq(virt_addr_internal[sector_off:64])
+		else:
+			self.comb += page_fetch_cmd[64: 128].eq(0x6E706E706E706E70), page_fetch_cmd[page_tag_off: 64].eq(virt_addr_internal[page_tag_off:])
 		fsm.act("TX_PAGE_FETCH_CMD", #6
-			self.cmd_tx.start.eq(1),
-			self.cmd_tx.len.eq(4),
-			self.cmd_tx.last.eq(1),
-			If(self.cmd_tx.ack,
-				NextState("TX_PAGE_FETCH_CMD0")
+			If(fetch_cmd_ok,
+				self.cmd_tx.start.eq(1),
+				self.cmd_tx.len.eq(4),
+				self.cmd_tx.last.eq(1),
+				If(self.cmd_tx.ack,
+					NextState("TX_PAGE_FETCH_CMD0")
+				)
 			)
 		)
 		for i in range(128//c_pci_data_width):
@@ -185,34 +596,75 @@ class PageTransferrer(Module):
 				self.cmd_tx.data.eq(page_fetch_cmd[i*c_pci_data_width:(i+1)*c_pci_data_width]),
 				self.cmd_tx.data_valid.eq(1),
 				If(self.cmd_tx.data_ren,
-					NextState("TX_PAGE_FETCH_CMD" + str(i+1)) if i+1 < 128//c_pci_data_width else NextState("RX_WAIT")
+					NextState("TX_PAGE_FETCH_CMD" + str(i+1)) if i+1 < 128//c_pci_data_width else
+					[fetch_queue_push.eq(1), NextState("REQ_COMPLETE")] if nfetches > 1 else NextState("RX_WAIT")
 				)
 			)
-		fsm.act("RX_WAIT", #8
+		def rx_complete():
+			return [self.fetch_done.eq(1), fetch_queue_pop.eq(1), NextState("RX_WAIT")] if nfetches > 1 else NextState("REQ_COMPLETE")
+
+		rx_fsm.act("RX_WAIT", #8
 			NextValue(rxcount, 0),
 			If(data_rx_transaction_requested,
 				NextValue(rlen, self.data_rx.len),
+				If(self.data_rx.len == 1,
+					NextState("RX_ZERO")
+				).Else(
+					NextState("RX_PAGE")
+				)
+				if zero_pages else
 				NextState("RX_PAGE")
 			)
 		)
-		fsm.act("RX_PAGE", #9
+		if zero_pages:
+			# zero page reply: take the word and clear the sector
+			rx_fsm.act("RX_ZERO",
+				self.data_rx.ack.eq(1),
+				data_rx_transaction_ack.eq(1),
+				If(self.data_rx.data_valid,
+					self.data_rx.data_ren.eq(1),
+					NextState("RX_ZERO_FILL")
+				)
+			)
+			rx_fsm.act("RX_ZERO_FILL",
+				wr_port.dat_w.eq(0),
+				rx_line_adr(rxcount),
+				If(rx_ok,
+					If(~rx_discard, wr_port.we.eq(2**flen(wr_port.we) - 1)),
+					NextValue(rxcount, rxcount + memorywidth//32),
+					If(rxcount >= sector_words - memorywidth//32,
+						rx_complete()
+					)
+				)
+			)
+		rx_fsm.act("RX_PAGE", #9
 			self.data_rx.ack.eq(1),
 			data_rx_transaction_ack.eq(1),
 			wr_port.dat_w.eq(Cat([self.data_rx.data for i in range(num_tx_per_word)])),
-			wr_port.adr[0:line_adr_nbits].eq(rxcount[pcie_word_adr_nbits: pcie_word_adr_nbits + line_adr_nbits]),
-			wr_port.adr[-page_adr_nbits:].eq(page_addr_internal),
-			If(self.data_rx.data_valid,
+			rx_line_adr(rxcount),
+			If(self.data_rx.data_valid & rx_ok,
 				self.data_rx.data_ren.eq(1),
-				[wr_port.we[i].eq(1) for i in range(c_pci_data_width//wordsize)]
-				if c_pci_data_width >= wordsize else
-				wr_port.we.eq(1 << rxcount[num_tx_off: num_tx_off + word_adr_nbits]),
+				If(~rx_discard,
+					[wr_port.we[i].eq(1) for i in range(c_pci_data_width//wordsize)]
+					if c_pci_data_width >= wordsize else
+					wr_port.we.eq(1 << rxcount[num_tx_off: num_tx_off + word_adr_nbits])
+				),
 				NextValue(rxcount, rxcount + c_pci_data_width//32),
-				If((rxcount >= (pagesize*8 - c_pci_data_width)//32) | (rxcount >= rlen - c_pci_data_width//32),
-					NextState("REQ_COMPLETE")
+				If((rxcount >= (sectorsize*8 - c_pci_data_width)//32) | (rxcount >= rlen - c_pci_data_width//32),
+					rx_complete()
 				)
 			)	
 		)
 
+		if counters:
+			self.sync += If(fsm.ongoing("IDLE") & self.fetch_req & ~self.send_req, self.fetches.eq(self.fetches + 1))
+			self.sync += If(fsm.ongoing("IDLE") & (self.send_req | self.flush_req), self.writebacks.eq(self.writebacks + 1))
+			self.sync += If(self.data_rx.data_valid & self.data_rx.data_ren, self.words_received.eq(self.words_received + c_pci_data_width//32))
+			self.sync += If(self.data_tx.data_valid & self.data_tx.data_ren, self.words_sent.eq(self.words_sent + c_pci_data_width//32))
+			# with nfetches > 1 rx_fsm also waits in RX_WAIT while no fetch is in flight
+			host_wait = rx_fsm.ongoing("RX_WAIT") & self.fetch_busy if nfetches > 1 else rx_fsm.ongoing("RX_WAIT")
+			self.sync += If(host_wait, self.host_wait_cycles.eq(self.host_wait_cycles + 1))
+
 
 
 class PageTransferrerTB(Module):
@@ -306,4 +758,4 @@ class PageTransferrerTB(Module):
 
 if __name__ == "__main__":
 	tb = PageTransferrerTB()
-	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
\ No newline at end of file
+	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
@@ -1,12 +1,35 @@
 from migen.fhdl.std import *
 
+from migen.genlib.misc import optree
 from migen.fhdl import verilog
 
 import itertools
 
+# maximum and index of the first maximum of the values that are valid, as a chain of comparators
+def max_index(module, values, valid=None):
+	nbits = len(values[0])
+	best = [Signal(nbits, name="best") for v in values]
+	best_valid = [Signal(name="best_valid") for v in values]
+	best_idx = [Signal(max=max(2, len(values)), name="best_idx") for v in values]
+	for i, v in enumerate(values):
+		valid_i = 1 if valid is None else valid[i]
+		if i == 0:
+			module.comb += best[i].eq(v), best_valid[i].eq(valid_i), best_idx[i].eq(0)
+		else:
+			module.comb += If(valid_i & (~best_valid[i-1] | (v > best[i-1])),
+				best[i].eq(v), best_valid[i].eq(1), best_idx[i].eq(i)
+			).Else(
+				best[i].eq(best[i-1]), best_valid[i].eq(best_valid[i-1]), best_idx[i].eq(best_idx[i-1])
+			)
+	return best[-1], best_idx[-1]
+
+# all policies: hit updates the state on an access to page pg_adr, fill marks pg_adr as newly allocated
+# (only the scan resistant policies distinguish the two), pg_to_replace is the page to evict next
+
 class TrueLRU(Module):
 	def __init__(self, npages=4):
 		self.hit = Signal()
+		self.fill = Signal()
 		self.pg_adr = Signal(log2_int(npages))
 		self.pg_to_replace = pg_to_replace = Signal(log2_int(npages))
 		self.npages = npages
@@ -16,7 +39,11 @@ class TrueLRU(Module):
 
 		self.sync += hit_p.eq(self.hit), pg_adr_p.eq(self.pg_adr)
 
-		rom_contents = [0x1B for i in range(2**((npages+1)*log2_int(npages)))]
+		# pages in order 0 (most recently used) to npages-1 (least recently used), also for the addresses that are no permutation
+		identity = 0
+		for s in range(npages):
+			identity = (identity << log2_int(npages)) | s
+		rom_contents = [identity for i in range(2**((npages+1)*log2_int(npages)))]
 
 		for state in itertools.permutations(range(npages)):
 			for page in range(npages):
@@ -33,7 +60,7 @@ class TrueLRU(Module):
 
 		rom = Array(rom_contents)
 
-		self.lru = lru = Signal(npages*log2_int(npages))
+		self.lru = lru = Signal(npages*log2_int(npages), reset=identity)
 		lru_addr = Signal((npages+1)*log2_int(npages))
 
 		self.comb += lru_addr.eq(Cat(lru, pg_adr_p))
@@ -42,26 +69,223 @@ class TrueLRU(Module):
 		self.comb += pg_to_replace.eq(lru[0:log2_int(npages)])
 
 
-# class PseudoLRU(Module):
-# 	def __init__(self, npages=4):
-# 		self.hit = hit = Signal()
-# 		self.pg_adr = pg_adr = Signal(log2_int(npages))
-# 		self.pg_to_replace = pg_to_replace = Signal(log2_int(npages))
-# 		self.npages = npages
+# tree pseudo LRU, npages-1 state bits
+# every node of the binary tree points to the half that was used less recently
+class PseudoLRU(Module):
+	def __init__(self, npages=4):
+		self.hit = Signal()
+		self.fill = Signal()
+		self.pg_adr = Signal(log2_int(npages))
+		self.pg_to_replace = pg_to_replace = Signal(log2_int(npages))
+		self.npages = npages
+
+		nlevels = log2_int(npages)
+
+		pg_adr_p = Signal(nlevels)
+		hit_p = Signal()
+
+		self.sync += hit_p.eq(self.hit), pg_adr_p.eq(self.pg_adr)
 
-# 		lru = Array([Array([Signal() for x in range(i+1)]) for i in range(log2_int(npages))])
-# 		lru_addr = Array([Signal()] + [Signal(i) for i in range(1,log2_int(npages)+1)])
+		# node i has children 2*i and 2*i+1, the root is node 1
+		self.tree = tree = [Signal(name="tree") for i in range(npages)]
 
-# 		self.comb += lru_addr[0].eq(0), lru_addr[1].eq(lru[0][lru_addr[0]])
-# 		for i in range(2, log2_int(npages) + 1):
-# 			self.comb += lru_addr[i].eq(Cat(lru[i-1][lru_addr[i-1]], lru_addr[i-1]))
-# 		self.comb += pg_to_replace.eq(lru_addr[-1])
+		# walk down from the root, the bits chosen so far (msb first) select the node on each level
+		path = [Signal(name="path") for l in range(nlevels)]
+		for l in range(nlevels):
+			nodes = tree[2**l:2**(l+1)]
+			self.comb += path[l].eq(Array(nodes)[Cat(*reversed(path[:l]))] if l > 0 else nodes[0])
+		self.comb += pg_to_replace.eq(Cat(*reversed(path)))
 
-# 		self.sync += If(hit, lru[0][0].eq(~pg_adr[-1])), [If(hit, lru[i][pg_adr[0:i]].eq(~pg_adr[-(i+1):])) for i in range(1, log2_int(npages))]
+		# on a hit, every node on the path of the page points away from it
+		for l in range(nlevels):
+			for j in range(2**l):
+				self.sync += If(hit_p & ((pg_adr_p[nlevels-l:] == j) if l > 0 else 1), tree[2**l + j].eq(~pg_adr_p[nlevels-1-l]))
+
+# exact LRU with a log2(npages) bit age counter per page (0 = most recently used)
+# the ages always form a permutation, the page with the maximum age is replaced
+class CounterLRU(Module):
+	def __init__(self, npages=4):
+		self.hit = Signal()
+		self.fill = Signal()
+		self.pg_adr = Signal(log2_int(npages))
+		self.pg_to_replace = pg_to_replace = Signal(log2_int(npages))
+		self.npages = npages
+
+		pg_adr_p = Signal(log2_int(npages))
+		hit_p = Signal()
+
+		self.sync += hit_p.eq(self.hit), pg_adr_p.eq(self.pg_adr)
+
+		self.age = age = Array(Signal(log2_int(npages), reset=i, name="age") for i in range(npages))
+
+		hit_age = Signal(log2_int(npages))
+		self.comb += hit_age.eq(age[pg_adr_p])
+
+		for i in range(npages):
+			self.sync += If(hit_p,
+				If(pg_adr_p == i,
+					age[i].eq(0)
+				).Elif(age[i] < hit_age,
+					age[i].eq(age[i] + 1)
+				)
+			)
+
+		self.comb += [If(age[i] == npages - 1, pg_to_replace.eq(i)) for i in range(npages)]
+
+# re-reference interval prediction (RRIP), an rrpv_nbits counter per page predicts how far away the next use is
+# pages are inserted with a long prediction and only move to 0 when they are referenced again, so a page that is
+# streamed through once is evicted before pages that are reused
+# a reference is a hit to another page than the previous hit or fill, the words of one burst count only once
+# the victim is the first page with the largest prediction, on a fill all other pages age until one reaches the maximum
+# bimodal (BRRIP): insert with the maximum prediction except for every brrip_throttle'th fill
+class RRIP(Module):
+	def __init__(self, npages=4, rrpv_nbits=2, bimodal=False, brrip_throttle=32):
+		self.hit = Signal()
+		self.fill = Signal()
+		self.pg_adr = Signal(log2_int(npages))
+		self.pg_to_replace = pg_to_replace = Signal(log2_int(npages))
+		self.npages = npages
+
+		rrpv_max = 2**rrpv_nbits - 1
+
+		pg_adr_p = Signal(log2_int(npages))
+		hit_p = Signal()
+		fill_p = Signal()
+		last_pg = Signal(log2_int(npages))
+
+		self.sync += hit_p.eq(self.hit), fill_p.eq(self.fill), pg_adr_p.eq(self.pg_adr)
+		self.sync += If(hit_p | fill_p, last_pg.eq(pg_adr_p))
+
+		self.rrpv = rrpv = Array(Signal(rrpv_nbits, reset=rrpv_max, name="rrpv") for i in range(npages))
+
+		# first page with the largest prediction
+		rrpv_victim, victim = max_index(self, [rrpv[i] for i in range(npages)])
+		self.comb += pg_to_replace.eq(victim)
+
+		insert = Signal(rrpv_nbits)
+		if bimodal:
+			fill_count = Signal(max=brrip_throttle)
+			self.sync += If(fill_p, fill_count.eq(Mux(fill_count == brrip_throttle - 1, 0, fill_count + 1)))
+			self.comb += insert.eq(Mux(fill_count == 0, rrpv_max - 1, rrpv_max))
+		else:
+			self.comb += insert.eq(rrpv_max - 1)
+
+		for i in range(npages):
+			self.sync += If(fill_p,
+				If(pg_adr_p == i,
+					rrpv[i].eq(insert)
+				).Else(
+					rrpv[i].eq(rrpv[i] + rrpv_max - rrpv_victim)
+				)
+			).Elif(hit_p & (pg_adr_p == i) & (last_pg != i),
+				rrpv[i].eq(0)
+			)
+
+class SRRIP(RRIP):
+	def __init__(self, npages=4):
+		RRIP.__init__(self, npages=npages)
+
+class BRRIP(RRIP):
+	def __init__(self, npages=4):
+		RRIP.__init__(self, npages=npages, bimodal=True)
+
+# 2Q style policy: filled pages are on probation (the FIFO A1 queue) until they are referenced again and move to
+# the main LRU queue (Am), pages on probation are evicted first once there are more than kin of them
+# (there is no queue of evicted tags, a second reference while on probation promotes the page instead)
+# references are counted like in RRIP, the age counters of CounterLRU order both queues
+class TwoQ(Module):
+	def __init__(self, npages=4, kin=None):
+		self.hit = Signal()
+		self.fill = Signal()
+		self.pg_adr = Signal(log2_int(npages))
+		self.pg_to_replace = pg_to_replace = Signal(log2_int(npages))
+		self.npages = npages
+
+		if kin is None:
+			kin = max(1, npages//4)
+
+		pg_adr_p = Signal(log2_int(npages))
+		hit_p = Signal()
+		fill_p = Signal()
+		last_pg = Signal(log2_int(npages))
+
+		self.sync += hit_p.eq(self.hit), fill_p.eq(self.fill), pg_adr_p.eq(self.pg_adr)
+		self.sync += If(hit_p | fill_p, last_pg.eq(pg_adr_p))
+
+		reference = Signal()
+		self.comb += reference.eq(hit_p & (pg_adr_p != last_pg))
+
+		self.age = age = Array(Signal(log2_int(npages), reset=i, name="age") for i in range(npages))
+		self.probation = probation = Array(Signal(reset=1, name="probation") for i in range(npages))
+
+		touched_age = Signal(log2_int(npages))
+		self.comb += touched_age.eq(age[pg_adr_p])
+
+		for i in range(npages):
+			self.sync += If(fill_p | reference,
+				If(pg_adr_p == i,
+					age[i].eq(0),
+					probation[i].eq(fill_p)
+				).Elif(age[i] < touched_age,
+					age[i].eq(age[i] + 1)
+				)
+			)
+
+		# oldest page of each queue
+		nprobation = Signal(max=npages+1)
+		self.comb += nprobation.eq(optree("+", [probation[i] for i in range(npages)]))
+		oldest_probation_age, oldest_probation = max_index(self, [age[i] for i in range(npages)], [probation[i] for i in range(npages)])
+		oldest_main_age, oldest_main = max_index(self, [age[i] for i in range(npages)], [~probation[i] for i in range(npages)])
+
+		self.comb += pg_to_replace.eq(Mux((nprobation > kin) | (nprobation == npages), oldest_probation, oldest_main))
+
+# set dueling between two policies for a set associative cache (pg_adr = Cat(set, way))
+# leader sets always use one of the policies and count their misses (fills) in psel,
+# the follower sets run both policies and evict with the one whose leader sets missed less
+class SetDueling(Module):
+	def __init__(self, policy_a, policy_b, nsets, nways, psel_nbits=10):
+		self.hit = Signal()
+		self.fill = Signal()
+		self.pg_adr = Signal(log2_int(nsets*nways))
+		self.replace_set = Signal(log2_int(nsets))
+		self.pg_to_replace = pg_to_replace = Signal(log2_int(nways))
+		self.psel = psel = Signal(psel_nbits, reset=2**(psel_nbits-1))
+
+		assert(nsets >= 2)
+
+		set_adr_nbits = log2_int(nsets)
+		fill_set = self.pg_adr[:set_adr_nbits]
+
+		# one leader set of each policy every 32 sets
+		spacing = min(32, nsets)
+		leaders_a = [s for s in range(nsets) if s % spacing == 0]
+		leaders_b = [s for s in range(nsets) if s % spacing == spacing - 1]
+
+		miss_a = Signal()
+		miss_b = Signal()
+		self.comb += miss_a.eq(self.fill & optree("|", [fill_set == s for s in leaders_a]))
+		self.comb += miss_b.eq(self.fill & optree("|", [fill_set == s for s in leaders_b]))
+		self.sync += If(miss_a & (psel != 2**psel_nbits - 1),
+			psel.eq(psel + 1)
+		).Elif(miss_b & (psel != 0),
+			psel.eq(psel - 1)
+		)
+
+		victims = []
+		for s in range(nsets):
+			set_policies = [cls(npages=nways) for cls in ([policy_a] if s in leaders_a else [policy_b] if s in leaders_b else [policy_a, policy_b])]
+			self.submodules += set_policies
+			for policy in set_policies:
+				self.comb += policy.hit.eq(self.hit & (self.pg_adr[:set_adr_nbits] == s)), policy.fill.eq(self.fill & (fill_set == s)), policy.pg_adr.eq(self.pg_adr[set_adr_nbits:])
+			victim = Signal(log2_int(nways))
+			self.comb += victim.eq(set_policies[0].pg_to_replace if len(set_policies) == 1 else Mux(psel[-1], set_policies[1].pg_to_replace, set_policies[0].pg_to_replace))
+			victims.append(victim)
+		self.comb += pg_to_replace.eq(Array(victims)[self.replace_set])
 
 class DummyPolicy(Module):
 	def __init__(self, npages=4):
 		self.hit = Signal()
+		self.fill = Signal()
 		self.pg_adr = Signal(log2_int(npages))
 		self.pg_to_replace = pg_to_replace = Signal(log2_int(npages))
 		self.npages = npages
@@ -71,12 +295,24 @@ class DummyPolicy(Module):
 class RoundRobin(Module):
 	def __init__(self, npages=4):
 		self.hit = Signal()
+		self.fill = Signal()
 		self.pg_adr = Signal(log2_int(npages))
 		self.pg_to_replace = pg_to_replace = Signal(log2_int(npages))
 		self.npages = npages
 
 		self.sync += If(self.hit, self.pg_to_replace.eq(self.pg_to_replace + 1))	
 
+# replacement policies selectable by name
+policies = {
+	"truelru": TrueLRU,
+	"pseudolru": PseudoLRU,
+	"counterlru": CounterLRU,
+	"srrip": SRRIP,
+	"brrip": BRRIP,
+	"2q": TwoQ,
+	"roundrobin": RoundRobin
+}
+
 def main():
 	plru = TrueLRU()
 	print(verilog.convert(plru, ios={plru.hit, plru.pg_adr, plru.pg_to_replace}))
@@ -2,28 +2,72 @@ from migen.fhdl.std import *
 from migen.sim.generic import run_simulation
 
 from replacementpolicies import *
+import cachesim
 
-from random import shuffle
+import random
 
 class TB(Module):
-	def __init__(self):
-		self.npages = 4
-		self.submodules.dut = TrueLRU(npages=self.npages)
+	def __init__(self, policy="truelru", npages=4, ntags=None, nrefs=200, duel=None, nsets=1):
+		# drives the policy like Virtmem with a fixed sequence of references to ntags pages (default 2*npages per set):
+		# a miss fills the victim and then hits it, pg_to_replace has to match the cachesim model after every step
+		# duel: second policy, both duel with SetDueling over nsets sets of npages pages each
+		self.npages = npages
+		self.policy = policy
+		self.duel = duel
+		self.nsets = nsets
+		self.ntags = 2*npages*nsets if ntags is None else ntags
+		self.nrefs = nrefs
+		if duel is None:
+			assert(nsets == 1)
+			self.submodules.dut = policies[policy](npages=self.npages)
+			self.model = cachesim.IndependentSets(cachesim.policies[policy], 1, npages)
+		else:
+			self.submodules.dut = SetDueling(policies[policy], policies[duel], nsets, npages)
+			self.model = cachesim.SetDuelingModel(cachesim.policies[policy], cachesim.policies[duel], nsets, npages)
+
+	def check(self, selfp, s):
+		if selfp.dut.pg_to_replace != self.model.victim(s):
+			print(self.policy + ": victim " + str(selfp.dut.pg_to_replace) + " instead of " + str(self.model.victim(s)) + " in set " + str(s))
+		assert(selfp.dut.pg_to_replace == self.model.victim(s))
 
 	def gen_simulation(self, selfp):
-		selfp.dut.lru = 135 # 2 0 1 3
+		rng = random.Random(self.npages)
+		resident = {}
 		yield
-		selfp.dut.hit = 1
-		test_adrs = list(range(16))
-		shuffle(test_adrs)
-		for i in test_adrs:
-			selfp.dut.pg_adr = i % self.npages
-			print("Hit " + str(i % self.npages))
+		for i in range(self.nrefs):
+			tag = rng.randrange(self.ntags)
+			s = tag % self.nsets
+			if self.duel is not None:
+				selfp.dut.replace_set = s
+				yield
+			self.check(selfp, s)
+			if tag not in resident.values():
+				pg = self.model.victim(s)
+				resident[(s, pg)] = tag
+				selfp.dut.pg_adr = s + pg*self.nsets
+				selfp.dut.fill = 1
+				yield
+				selfp.dut.fill = 0
+				self.model.fill(s, pg)
+			pg = [p for (t_s, p), t in resident.items() if t == tag][0]
+			# a burst of nwords words hits the page once per word
+			nwords = rng.randint(1, 3)
+			selfp.dut.pg_adr = s + pg*self.nsets
+			selfp.dut.hit = 1
+			yield nwords
+			selfp.dut.hit = 0
+			self.model.hit(s, pg, nwords)
 			yield 3
-			print("LRU: " + str(selfp.dut.pg_to_replace))
-
+		print(self.policy + ("" if self.duel is None else " dueling with " + self.duel) + " with " + str(self.npages) + " pages per set matches the model")
 
 
 if __name__ == "__main__":
-	tb = TB()
-	run_simulation(tb, vcd_name="tb.vcd", ncycles=5000)
\ No newline at end of file
+	for policy in sorted(policies):
+		# truelru keeps a ROM of all page orders
+		for npages in [2, 4] + ([8] if policy != "truelru" else []):
+			tb = TB(policy, npages=npages)
+			run_simulation(tb, vcd_name="tb.vcd", ncycles=5000)
+	# set dueling with leader sets 0 and 3 and two follower sets
+	for policy, duel in ("srrip", "truelru"), ("2q", "brrip"):
+		tb = TB(policy, npages=4, duel=duel, nsets=4, nrefs=400)
+		run_simulation(tb, vcd_name="tb.vcd", ncycles=20000)
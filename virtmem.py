@@ -2,15 +2,185 @@ import sys
 
 from migen.fhdl.std import *
 from migen.genlib.fsm import FSM, NextState, NextValue
+from migen.genlib.misc import optree
+from migen.genlib.record import *
 
 from migen.fhdl import verilog
 
 import replacementpolicies, pagetransfer
 from riffa import GenericRiffa, Interface
 
+_port_layout = [
+	("req",				1,					DIR_M_TO_S),
+	("virt_addr",		"ptrsize",			DIR_M_TO_S),
+	("num_words",		"ptrsize",			DIR_M_TO_S),
+	("write_enable",	1,					DIR_M_TO_S),
+	("data_write",		"wordsize",			DIR_M_TO_S),
+	("data_write_line",	"line_width",		DIR_M_TO_S),
+	("data_write_mask",	"line_words",		DIR_M_TO_S),
+	("write_only",		1,					DIR_M_TO_S),
+	("flush_all",		1,					DIR_M_TO_S),
+	("flush_range",		1,					DIR_M_TO_S),
+	("invalidate_range",	1,					DIR_M_TO_S),
+	("pin",				1,					DIR_M_TO_S),
+	("unpin_all",		1,					DIR_M_TO_S),
+	("stream_id",		"stream_id_nbits",	DIR_M_TO_S),
+	("data_read",		"wordsize",			DIR_S_TO_M),
+	("data_read_line",	"line_width",		DIR_S_TO_M),
+	("data_read_mask",	"line_words",		DIR_S_TO_M),
+	("data_valid",		1,					DIR_S_TO_M),
+	("write_ack",		1,					DIR_S_TO_M),
+	("write_ack_mask",	"line_words",		DIR_S_TO_M),
+	("done",			1,					DIR_S_TO_M),
+	("miss",			1,					DIR_S_TO_M)
+]
+
+class VirtmemPort(Record):
+	def __init__(self, c_pci_data_width=32, wordsize=32, ptrsize=64, nstreams=0):
+		Record.__init__(self, set_layout_parameters(_port_layout,
+			ptrsize=ptrsize, wordsize=wordsize, line_width=max(c_pci_data_width, wordsize), line_words=max(1, c_pci_data_width//wordsize), stream_id_nbits=bits_for(max(2, nstreams) - 1)))
+
+class Scratchpad(Module):
+	def __init__(self, rd_port, wr_port, first_page, npages, pagesize=4096, wordsize=32, ptrsize=64):
+		# rd_port, wr_port: block RAM ports shared with the cache, the npages scratchpad pages start at page first_page of it
+		# direct access: the word at adr is read (re) or written (we) in the cycles enable is raised,
+		#   read data is in dat_r with valid in the next cycle
+		self.enable = Signal()
+		self.adr = Signal(max=max(2, npages*pagesize*8//wordsize))
+		self.re = Signal()
+		self.we = Signal()
+		self.dat_w = Signal(wordsize)
+		self.dat_r = Signal(wordsize)
+		self.valid = Signal()
+		# load or store of whole pages in progress, driven by the page_control_fsm of Virtmem (see start and add_transfer_states)
+		self.virt_addr = Signal(ptrsize)
+		self.page = Signal(max=max(2, npages))
+		self.pages_left = Signal(ptrsize - log2_int(pagesize))
+		self.loading = Signal()
+		self.active = Signal()
+		self.page_off = log2_int(pagesize)
+		self.page_word_nbits = log2_int(pagesize*8//wordsize)
+		self.pagesize = pagesize
+		self.first_page = first_page
+		###
+
+		base = first_page*pagesize*8//flen(rd_port.dat_r)
+		line_words = flen(rd_port.dat_r)//wordsize
+		word_nbits = log2_int(line_words)
+		word_p = Signal(max(1, word_nbits))
+		self.comb += If(self.enable & self.re,
+				rd_port.adr.eq(base + self.adr[word_nbits:]),
+				rd_port.re.eq(1)
+			)
+		self.comb += If(self.enable & self.we,
+				wr_port.adr.eq(base + self.adr[word_nbits:]),
+				wr_port.dat_w.eq(Replicate(self.dat_w, line_words)),
+				wr_port.we.eq(1 << self.adr[:word_nbits] if line_words > 1 else 2**flen(wr_port.we) - 1)
+			)
+		self.sync += self.valid.eq(self.enable & self.re), word_p.eq(self.adr[:word_nbits] if line_words > 1 else 0)
+		self.comb += self.dat_r.eq(Array(rd_port.dat_r[i*wordsize:(i+1)*wordsize] for i in range(line_words))[word_p])
+
+	# FSM actions that begin to load (or store) the pages from virt_addr to virt_addr + nbytes at scratchpad word sp_adr
+	def start(self, virt_addr, nbytes, sp_adr, load):
+		return [
+			NextValue(self.virt_addr, virt_addr),
+			NextValue(self.page, sp_adr[self.page_word_nbits:]),
+			NextValue(self.pages_left, (nbytes + self.pagesize - 1)[self.page_off:]),
+			NextValue(self.loading, load),
+			NextValue(self.active, 1)
+		]
+
+	# states of fsm that transfer one page at a time with pagetransferrer,
+	# a load ends with the actions loaded, a store with stored
+	def add_transfer_states(self, fsm, pagetransferrer, loaded, stored):
+		fsm.act("SP_TRANSFER_INIT",
+			If(self.pages_left == 0,
+				If(self.loading,
+					NextValue(self.active, 0),
+					loaded
+				).Else(
+					stored
+				)
+			).Else(
+				pagetransferrer.virt_addr.eq(0),
+				pagetransferrer.virt_addr[self.page_off:].eq(self.virt_addr[self.page_off:]),
+				pagetransferrer.page_addr.eq(self.first_page + self.page),
+				pagetransferrer.wb_mask.eq(2**flen(pagetransferrer.wb_mask) - 1),
+				pagetransferrer.fetch_req.eq(self.loading),
+				pagetransferrer.send_req.eq(~self.loading),
+				NextState("SP_TRANSFER_WAIT")
+			)
+		)
+		fsm.act("SP_TRANSFER_WAIT",
+			If(pagetransferrer.req_complete,
+				NextValue(self.virt_addr, self.virt_addr + self.pagesize),
+				NextValue(self.page, self.page + 1),
+				NextValue(self.pages_left, self.pages_left - 1),
+				NextState("SP_TRANSFER_INIT")
+			)
+		)
+
 class Virtmem(Module):
 
-	def __init__(self, rx0, tx0, rx1, tx1, c_pci_data_width=32, wordsize=32, ptrsize=64, npagesincache=4, pagesize=4096):
+	def __init__(self, rx0, tx0, rx1, tx1, c_pci_data_width=32, wordsize=32, ptrsize=64, npagesincache=4, pagesize=4096, nways=None, nmshr=0, prefetch_depth=0, nstreams=0, stride_distance=2, sectorsize=None, dirtysize=None, wide_read=False, wide_write=False, nports=1, arbitration="roundrobin", write_nofetch=False, victim_buffer=False, clean_watermark=None, replacement="truelru", replacement_duel=None, tag_bram=False, nfetches=1, coalesce_flush=False, zero_pages=False, counters=False, pinning=False, partitions=None, scratchpad_pages=0, push=False):
+		# pagesize: size of a cache page in bytes, huge pages (e.g. 64 KiB to 2 MiB) cost one fetch per page instead of one per 4 KiB,
+		#   the cache has to fit in block RAM, sectorsize limits fills to a part of the page
+		# nways: associativity of the page cache (None = fully associative)
+		# nmshr: number of outstanding misses in non-blocking mode (0 = blocking cache)
+		#   in non-blocking mode a request that misses at its first word ends with done and miss asserted
+		#   instead of waiting for the page: the fetch continues in the background and the request has to be reissued,
+		#   so the kernel can serve other requests from resident pages in the meantime (misses inside a burst still wait)
+		# prefetch_depth: number of pages fetched ahead once sequential page accesses are detected (0 = no prefetching)
+		# nstreams: number of request streams (selected by stream_id) the stride prefetcher learns a constant stride for (0 = no stride prefetching)
+		# stride_distance: how many strides ahead of the current request the stride prefetcher fetches
+		# sectorsize: fill granularity, a miss only fetches the sector containing the address and pages keep a valid bit per sector
+		#   (None = whole pages, sectors are only supported by the blocking cache)
+		# dirtysize: granularity of dirty tracking, only the dirty blocks of a page are written back (None = sectorsize)
+		# wide_read: burst reads advance by a whole memory line per cycle instead of one word,
+		#   data_read_line holds the line and data_read_mask the words of it that belong to the burst
+		# wide_write: burst writes store a whole memory line per cycle from data_write_line, limited to the words enabled in data_write_mask,
+		#   write_ack_mask tells which words of the line were accepted with write_ack
+		# nports: number of client ports (VirtmemPort in self.ports), each request is served to completion before the next port is granted
+		#   with nports > 1 the kernel uses self.ports instead of the request signals below,
+		#   a port pulses req like a single kernel and keeps its other inputs until done, also while another port is served
+		# arbitration: "roundrobin" or "priority" (lower port number wins) between requesting ports
+		# write_nofetch: a write miss allocates the page (or sector) without fetching it when the burst overwrites all of it,
+		#   or when the kernel raises write_only with the request (the unwritten words of the page are undefined then)
+		#   only in blocking mode, misses handled by the MSHRs always fetch
+		# victim_buffer: a dirty victim is copied out to a buffer and written back while the new page is fetched (blocking mode only)
+		# clean_watermark: while idle, write back dirty pages (least recently used first with truelru) as long as more than clean_watermark pages are dirty
+		#   (None = dirty pages are only written back on eviction and flush)
+		# replacement: replacement policy, one of replacementpolicies.policies
+		#   truelru enumerates all page orders in a ROM, use pseudolru or counterlru for more than 8 pages (per set)
+		#   srrip, brrip and 2q keep pages that are reused resident while other pages are streamed through
+		# replacement_duel: second replacement policy, set dueling picks the policy with fewer misses at runtime (needs nways and more than one set)
+		# tag_bram: keep the page tags in block RAM, one row with the tags of all ways per set, instead of in registers
+		#   the row of the looked up set is read in the lookup cycle and compared in the next, so found_p/pg_adr_p keep their timing
+		#   needs more than one set, only in blocking mode without prefetching
+		# nfetches: number of page fetches of the MSHRs in flight at once, fetch commands are sent back-to-back
+		#   and the pages are received in order (needs nmshr or prefetching)
+		# flush_range / invalidate_range: like flush_all, but only for the pages overlapping the num_words words at virt_addr,
+		#   invalidate_range drops the pages without writing them back
+		#   the host sends [0xAF1005, length in bytes, address (64 bit)] or [0xAC105E, ...] for the same on the command channel
+		# coalesce_flush: flush_all and the flush command write back all dirty pages in a single transaction (see PageTransferrer),
+		#   only with whole page writebacks (no sectors or dirty blocks), without victim buffer and tag_bram
+		# zero_pages: all zero pages are transferred as short messages instead of their data (see PageTransferrer)
+		# counters: performance counters (self.counters, see below), the host reads a snapshot by sending 0x57A75,
+		#   the reply is [number of counters, 0, 0x57A757A7, 0x57A757A7] followed by the 32 bit counters
+		# pinning: pinned pages are not chosen for replacement as long as their set has another page that can be replaced
+		#   the pages a request accesses with pin raised are pinned, unpin_all unpins all pages,
+		#   the host pins or unpins the resident pages of a range with [0xAB10C or 0xAF2EE, length in bytes, address (64 bit)]
+		# partitions: with nports > 1, one mask per port of the ways (pages of the fully associative cache) its misses may replace
+		# scratchpad_pages: the last scratchpad_pages of the npagesincache pages of block RAM are a scratchpad instead of cache pages,
+		#   the kernel reads and writes it by word address (sp_adr, sp_re, sp_we) in the cycles sp_ack is raised (while no request is served),
+		#   read data is in sp_dat_r with sp_valid in the next cycle,
+		#   sp_load copies the pages of virt_addr to virt_addr + num_words words into the scratchpad at sp_adr, sp_store copies them back,
+		#   both are page aligned, take whole pages and are done like flush_range (the host sees ordinary fetches and writebacks),
+		#   sp_load first writes back the dirty cached pages of the range, sp_store invalidates its cached pages afterwards
+		# push: the host pushes a page ahead of its first access with [0x9054, length in bytes, address (64 bit)]
+		#   followed by the page on the data channel like the reply to a fetch, the page takes the slot a miss would replace
+		#   if that slot is free or clean and is dropped otherwise or if it is resident already,
+		#   pages are pushed while the kernel is not waiting for a fetch (e.g. before it is started)
 		self.cmd_rx = rx0
 		self.cmd_tx = tx0
 		self.data_rx = rx1
@@ -19,23 +189,106 @@ class Virtmem(Module):
 		self.virt_addr = Signal(ptrsize)
 		self.num_words = Signal(ptrsize)
 		self.data_read = Signal(wordsize)
+		self.data_read_line = Signal(max(c_pci_data_width, wordsize))
+		self.data_read_mask = Signal(max(1, c_pci_data_width//wordsize))
 		self.data_valid = Signal()
 		self.done = Signal()
 		self.data_write = Signal(wordsize)
+		self.data_write_line = Signal(max(c_pci_data_width, wordsize))
+		self.data_write_mask = Signal(max(1, c_pci_data_width//wordsize))
+		self.write_ack_mask = Signal(max(1, c_pci_data_width//wordsize))
 		self.write_enable = Signal()
 		self.write_ack = Signal()
+		self.write_only = Signal()
+		self.pin = Signal()
+		self.unpin_all = Signal()
 		self.flush_all = Signal()
+		self.flush_range = Signal()
+		self.invalidate_range = Signal()
+		self.miss = Signal()
+		self.sp_adr = Signal(max=max(2, scratchpad_pages*pagesize*8//wordsize))
+		self.sp_re = Signal()
+		self.sp_we = Signal()
+		self.sp_dat_w = Signal(wordsize)
+		self.sp_dat_r = Signal(wordsize)
+		self.sp_ack = Signal()
+		self.sp_valid = Signal()
+		self.sp_load = Signal()
+		self.sp_store = Signal()
+		self.prefetch_issued = Signal(32)
+		self.prefetch_useful = Signal(32)
+		self.prefetch_useless = Signal(32)
+		self.stream_id = Signal(max=max(2, nstreams))
+		self.counters = []
+		self.ports = [VirtmemPort(c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize, nstreams=nstreams) for i in range(nports)] if nports > 1 else []
 		###
 
+		# port arbitration, a port keeps the grant from its request until done
+		assert(arbitration in ("roundrobin", "priority"))
+		if nports > 1:
+			port_request = Signal(nports)
+			port_grant = Signal(max=nports)
+			port_locked = Signal()
+			next_port = Signal(max=nports)
+			port_sel = Signal(max=nports)
+			# request pulses of ports that are not granted right away are kept until they are
+			requests = "req", "flush_all", "flush_range", "invalidate_range"
+			port_pending = dict((name, Signal(nports, name="port_pending_" + name)) for name in requests)
+			port_requests = dict((name, [getattr(port, name) | port_pending[name][i] for i, port in enumerate(self.ports)]) for name in requests)
+			self.comb += port_request.eq(Cat(*[optree("|", [port_requests[name][i] for name in requests]) for i in range(nports)]))
+			for name in requests:
+				self.sync += [If(~port_locked & (port_request != 0) & (next_port == i),
+						port_pending[name][i].eq(0)
+					).Elif(getattr(port, name),
+						port_pending[name][i].eq(1)
+					) for i, port in enumerate(self.ports)]
+			if arbitration == "roundrobin":
+				# first requesting port after the last granted one
+				cases = {}
+				for i in range(nports):
+					choice = []
+					for j in reversed(range(i+1, i+1+nports)):
+						choice = [If(port_request[j % nports], next_port.eq(j % nports)).Else(*choice)]
+					cases[i] = choice
+				self.comb += next_port.eq(port_grant), Case(port_grant, cases)
+			else:
+				self.comb += next_port.eq(0), [If(port_request[i], next_port.eq(i)) for i in reversed(range(nports))]
+			self.comb += port_sel.eq(Mux(port_locked, port_grant, next_port))
+			self.sync += If(port_locked,
+					If(self.done,
+						port_locked.eq(0)
+					)
+				).Elif(port_request != 0,
+					port_grant.eq(next_port),
+					port_locked.eq(1)
+				)
+			for name in "virt_addr", "num_words", "write_enable", "data_write", "data_write_line", "data_write_mask", "write_only", "pin", "stream_id":
+				self.comb += getattr(self, name).eq(Array(getattr(port, name) for port in self.ports)[port_sel])
+			for name in requests:
+				self.comb += getattr(self, name).eq(Array(port_requests[name])[port_sel])
+			self.comb += self.unpin_all.eq(optree("|", [port.unpin_all for port in self.ports]))
+			for i, port in enumerate(self.ports):
+				self.comb += port.data_read.eq(self.data_read), port.data_read_line.eq(self.data_read_line), port.data_read_mask.eq(self.data_read_mask), port.write_ack_mask.eq(self.write_ack_mask)
+				self.comb += [getattr(port, name).eq(getattr(self, name) & port_locked & (port_grant == i)) for name in ("data_valid", "write_ack", "done", "miss")]
+
 		# register I/Os
 		virt_addr_p = Signal(ptrsize)
 		req_p = Signal()
 		num_words_p = Signal(ptrsize)
 		data_write_p = Signal(wordsize)
+		data_write_line_p = Signal(max(c_pci_data_width, wordsize))
 		write_enable_p = Signal()
+		write_only_p = Signal()
+		pin_p = Signal()
 		flush_all_p = Signal()
+		flush_range_p = Signal()
+		invalidate_range_p = Signal()
+		sp_adr_p = Signal(flen(self.sp_adr))
+		sp_load_p = Signal()
+		sp_store_p = Signal()
+		stream_id_p = Signal(max=max(2, nstreams))
 
-		self.sync += virt_addr_p.eq(self.virt_addr), req_p.eq(self.req), data_write_p.eq(self.data_write), write_enable_p.eq(self.write_enable), flush_all_p.eq(self.flush_all), num_words_p.eq(self.num_words)
+		self.sync += virt_addr_p.eq(self.virt_addr), data_write_p.eq(self.data_write), data_write_line_p.eq(self.data_write_line), write_enable_p.eq(self.write_enable), write_only_p.eq(self.write_only), pin_p.eq(self.pin), sp_adr_p.eq(self.sp_adr), num_words_p.eq(self.num_words), stream_id_p.eq(self.stream_id)
 
 		self.data_valid_n = Signal()
 		self.sync += self.data_valid.eq(self.data_valid_n)
@@ -58,8 +311,12 @@ class Virtmem(Module):
 		self.sync += If(data_rx_transaction_ack, data_rx_transaction_requested.eq(0)).Elif(~data_rx_transaction_requested & (self.data_rx.start == 1) & (data_rx_start_prev == 0), data_rx_transaction_requested.eq(1))
 
 		# constant definitions
+		# the cache keeps the first npagesincache - scratchpad_pages pages of the block RAM
+		mempages = npagesincache
+		npagesincache -= scratchpad_pages
+		assert(npagesincache > 0)
 		memorywidth = max(c_pci_data_width, wordsize)
-		memorysize = npagesincache*pagesize*8//memorywidth
+		memorysize = mempages*pagesize*8//memorywidth
 
 		pcie_word_adr_nbits = log2_int(memorywidth//32)
 		num_tx_off = log2_int(c_pci_data_width//32)
@@ -79,21 +336,90 @@ class Virtmem(Module):
 
 		page_tag_nbits = ptrsize - page_tag_off
 
+		if nways is None:
+			nways = npagesincache
+		assert(npagesincache % nways == 0)
+
+		if sectorsize is None:
+			sectorsize = pagesize
+		assert(pagesize % sectorsize == 0)
+		nsectors = pagesize//sectorsize
+		sector_off = log2_int(sectorsize)
+
+		if dirtysize is None:
+			dirtysize = sectorsize
+		assert(sectorsize % dirtysize == 0)
+		ndirty = pagesize//dirtysize
+		dirty_off = log2_int(dirtysize)
+		nsets = npagesincache//nways
+		way_adr_nbits = log2_int(nways)
+		set_adr_nbits = log2_int(nsets)
+
+		# pages are fetched in the background by mshr_fsm when running non-blocking or prefetching
+		pf_depth = max(prefetch_depth, 1 if nstreams else 0)
+		n_mshr = nmshr if nmshr else pf_depth + 1 if pf_depth else 0
+		assert(nsectors == 1 or not n_mshr)
+		assert(not (victim_buffer and n_mshr))
+		assert(not tag_bram or (nsets > 1 and not n_mshr))
+		assert(nfetches == 1 or n_mshr)
+		assert(not coalesce_flush or (nsectors == 1 and ndirty == 1 and not victim_buffer and not tag_bram))
+		assert(not scratchpad_pages or (nports == 1 and not n_mshr and nsectors == 1 and not coalesce_flush))
+		assert(not push or (not n_mshr and nsectors == 1))
+
+		# cache page address of way w in set s: set index in the low bits
+		def set_way_adr(s, w):
+			if nways == 1:
+				return s
+			elif nsets == 1:
+				return w
+			else:
+				return Cat(s, C(w, way_adr_nbits))
 
 		# cache memory
 		self.specials.mem = Memory(memorywidth, memorysize, init=[i+0xABBA for i in range(memorysize)])
 		
-		self.specials.rd_port = rd_port = self.mem.get_port(has_re=True)
+		if n_mshr:
+			# page transfers run concurrently with cache hits: one read/write port each
+			self.specials.rd_port = rd_port = wr_port = self.mem.get_port(write_capable=True, has_re=True, we_granularity=min(wordsize, c_pci_data_width))
+			self.specials.transfer_port = transfer_rd_port = transfer_wr_port = self.mem.get_port(write_capable=True, has_re=True, we_granularity=min(wordsize, c_pci_data_width))
+		else:
+			self.specials.rd_port = rd_port = self.mem.get_port(has_re=True)
 
-		self.specials.wr_port = wr_port = self.mem.get_port(write_capable=True, we_granularity=min(wordsize, c_pci_data_width))
+			self.specials.wr_port = wr_port = self.mem.get_port(write_capable=True, we_granularity=min(wordsize, c_pci_data_width))
+
+			transfer_rd_port = rd_port
+			transfer_wr_port = wr_port
 		
 
 		# cache status
 		pg_adr = Signal(page_adr_nbits)
 
-		page_tags = Array(Signal(page_tag_nbits, name="page_tags") for i in range(npagesincache))
+		page_tags = Array(Signal(page_tag_nbits, name="page_tags") for i in range(npagesincache)) if not tag_bram else None
 		page_valid = Array(Signal(name="page_valid") for i in range(npagesincache))
 		page_dirty = Array(Signal(name="page_dirty") for i in range(npagesincache))
+		page_sectors = Array(Signal(nsectors, name="page_sectors") for i in range(npagesincache))
+		page_dirty_blocks = Array(Signal(ndirty, name="page_dirty_blocks") for i in range(npagesincache))
+
+		def set_dirty(pg, addr):
+			return [
+				NextValue(page_dirty[pg], 1),
+				NextValue(page_dirty_blocks[pg], page_dirty_blocks[pg] | (1 << addr[dirty_off:page_tag_off])) if ndirty > 1 else []
+			]
+
+		def clear_dirty(pg):
+			return [
+				NextValue(page_dirty[pg], 0),
+				NextValue(page_dirty_blocks[pg], 0) if ndirty > 1 else []
+			]
+
+		# blocks of a page to write back
+		def writeback_mask(pg):
+			if ndirty > 1:
+				return self.pagetransferrer.wb_mask.eq(page_dirty_blocks[pg])
+			elif nsectors > 1:
+				return self.pagetransferrer.wb_mask.eq(page_sectors[pg])
+			else:
+				return []
 
 		found = Signal()
 		cache_hit_en = Signal()
@@ -101,22 +427,147 @@ class Virtmem(Module):
 		lookup_virt_addr = Signal(ptrsize)
 		pg_adr_p = Signal(page_adr_nbits)
 		found_p = Signal()
-		self.sync += found_p.eq(found), pg_adr_p.eq(pg_adr)
+		if not tag_bram:
+			self.sync += found_p.eq(found), pg_adr_p.eq(pg_adr)
 
-		self.comb += [If((page_tags[i] == lookup_virt_addr[page_tag_off:ptrsize]) & page_valid[i], found.eq(1), pg_adr.eq(i)) for i in range(npagesincache)]
-		
-		# replacement policy
-		self.submodules.replacement_policy = replacementpolicies.TrueLRU(npages=npagesincache)
-		pg_to_replace = self.replacement_policy.pg_to_replace
-		self.comb += self.replacement_policy.hit.eq(found_p & cache_hit_en), self.replacement_policy.pg_adr.eq(pg_adr_p)
+		def page_lookup(tag, found, pg_adr):
+			if nsets == 1:
+				return [If((page_tags[i] == tag) & page_valid[i], found.eq(1), pg_adr.eq(i)) for i in range(npagesincache)]
+			else:
+				# only compare against the nways pages of the set selected by the low tag bits
+				tag_set = tag[:set_adr_nbits]
+				return [If((page_tags[set_way_adr(tag_set, w)] == tag) & page_valid[set_way_adr(tag_set, w)], found.eq(1), pg_adr.eq(set_way_adr(tag_set, w))) for w in range(nways)]
 
-		# page transfer module
-		self.submodules.pagetransferrer = pagetransfer.PageTransferrer(rx0, tx0, rx1, tx1, rd_port, wr_port, c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize, npagesincache=npagesincache, pagesize=pagesize)
+		# found: the word is in the cache, page_found: the page is (but maybe not the sector)
+		page_found = Signal()
+		page_found_p = Signal()
+		if tag_bram:
+			self.specials.tag_mem = Memory(nways*page_tag_nbits, nsets)
+			self.specials.tag_lookup_port = tag_lookup_port = self.tag_mem.get_port()
+			self.specials.tag_port = tag_port = self.tag_mem.get_port(write_capable=True, we_granularity=page_tag_nbits)
+
+			lookup_virt_addr_p = Signal(ptrsize)
+			lookup_set_p = Signal(set_adr_nbits)
+			self.sync += lookup_virt_addr_p.eq(lookup_virt_addr)
+			self.comb += tag_lookup_port.adr.eq(lookup_virt_addr[page_tag_off:page_tag_off+set_adr_nbits]), lookup_set_p.eq(lookup_virt_addr_p[page_tag_off:page_tag_off+set_adr_nbits])
+			self.comb += [If((tag_lookup_port.dat_r[w*page_tag_nbits:(w+1)*page_tag_nbits] == lookup_virt_addr_p[page_tag_off:]) & page_valid[set_way_adr(lookup_set_p, w)],
+					page_found_p.eq(1), pg_adr_p.eq(set_way_adr(lookup_set_p, w))
+				) for w in range(nways)]
+			self.comb += found_p.eq(page_found_p & (page_sectors[pg_adr_p] >> lookup_virt_addr_p[sector_off:page_tag_off])[0] if nsectors > 1 else page_found_p)
+
+			# the tag port writes the tag of an allocated page and otherwise reads the row of the page to write back
+			tag_we = Signal()
+			tag_wr_pg = Signal(page_adr_nbits)
+			tag_wr_tag = Signal(page_tag_nbits)
+			tag_wb_pg = Signal(page_adr_nbits)
+			self.comb += tag_port.adr.eq(Mux(tag_we, tag_wr_pg[:set_adr_nbits], tag_wb_pg[:set_adr_nbits])), tag_port.dat_w.eq(Replicate(tag_wr_tag, nways))
+			self.comb += tag_port.we.eq(Mux(tag_we, 1 << tag_wr_pg[set_adr_nbits:] if nways > 1 else 1, 0))
+		elif nsectors > 1:
+			self.sync += page_found_p.eq(page_found)
+			self.comb += page_lookup(lookup_virt_addr[page_tag_off:ptrsize], page_found, pg_adr)
+			self.comb += found.eq(page_found & (page_sectors[pg_adr] >> lookup_virt_addr[sector_off:page_tag_off])[0])
+		else:
+			self.comb += page_lookup(lookup_virt_addr[page_tag_off:ptrsize], found, pg_adr)
+
+		def set_tag(pg, tag):
+			if tag_bram:
+				return [tag_we.eq(1), tag_wr_pg.eq(pg), tag_wr_tag.eq(tag)]
+			else:
+				return NextValue(page_tags[pg], tag)
+
+		# tag of a page to write back, read from block RAM in PAGE_WB_TAG
+		def writeback_tag(pg):
+			if tag_bram:
+				return Array(tag_port.dat_r[w*page_tag_nbits:(w+1)*page_tag_nbits] for w in range(nways))[pg[set_adr_nbits:]] if nways > 1 else tag_port.dat_r
+			else:
+				return page_tags[pg]
+		wb_init = "PAGE_WB_TAG" if tag_bram else "PAGE_WB_INIT"
 
 		# state machine that controls page cache
-		page_control_fsm = FSM()
+		page_control_fsm = FSM(reset_state="IDLE")
 		self.submodules += page_control_fsm
 
+		# kernel requests are kept until IDLE takes them, the cache may be busy cleaning or with a host command when they arrive
+		for request, request_p in (self.req, req_p), (self.flush_all, flush_all_p), (self.flush_range, flush_range_p), (self.invalidate_range, invalidate_range_p), (self.sp_load, sp_load_p), (self.sp_store, sp_store_p):
+			self.sync += request_p.eq(request | (request_p & ~page_control_fsm.ongoing("IDLE")))
+
+		# replacement policy
+		# state is updated on cache hits (and on page allocation when fetching in the background),
+		# fill is raised for pg_to_replace once the page has been allocated
+		policy_hit = Signal()
+		policy_fill = Signal()
+		policy_pg_adr = Signal(page_adr_nbits)
+		self.comb += policy_hit.eq(found_p & cache_hit_en)
+
+		assert(replacement in replacementpolicies.policies)
+		assert(replacement_duel is None or (replacement_duel in replacementpolicies.policies and nsets > 1 and nways > 1))
+		policy_cls = replacementpolicies.policies[replacement]
+		if nsets == 1:
+			self.submodules.replacement_policy = policy_cls(npages=npagesincache)
+			pg_to_replace = self.replacement_policy.pg_to_replace
+			self.comb += self.replacement_policy.hit.eq(policy_hit), self.replacement_policy.fill.eq(policy_fill), self.replacement_policy.pg_adr.eq(policy_pg_adr)
+		else:
+			# one replacement state per set, victim is chosen in the set of the missing address
+			# (virt_addr_internal is only loaded when leaving IDLE)
+			replace_set = Signal(set_adr_nbits)
+			self.comb += replace_set.eq(Mux(page_control_fsm.ongoing("IDLE"), virt_addr_p[page_tag_off:page_tag_off+set_adr_nbits], self.virt_addr_internal[page_tag_off:page_tag_off+set_adr_nbits]))
+			pg_to_replace = Signal(page_adr_nbits)
+			if nways == 1:
+				self.comb += pg_to_replace.eq(replace_set)
+			elif replacement_duel is not None:
+				self.submodules.replacement_policy = replacementpolicies.SetDueling(policy_cls, replacementpolicies.policies[replacement_duel], nsets, nways)
+				self.comb += self.replacement_policy.hit.eq(policy_hit), self.replacement_policy.fill.eq(policy_fill), self.replacement_policy.pg_adr.eq(policy_pg_adr), self.replacement_policy.replace_set.eq(replace_set)
+				self.comb += pg_to_replace.eq(Cat(replace_set, self.replacement_policy.pg_to_replace))
+			else:
+				self.replacement_policies = [policy_cls(npages=nways) for s in range(nsets)]
+				self.submodules += self.replacement_policies
+				for s, policy in enumerate(self.replacement_policies):
+					self.comb += policy.hit.eq(policy_hit & (policy_pg_adr[:set_adr_nbits] == s)), policy.fill.eq(policy_fill & (policy_pg_adr[:set_adr_nbits] == s)), policy.pg_adr.eq(policy_pg_adr[set_adr_nbits:])
+				self.comb += pg_to_replace.eq(Cat(replace_set, Array(policy.pg_to_replace for policy in self.replacement_policies)[replace_set]))
+
+		# pinned pages (and ways outside the partition of the port) are skipped:
+		# if the policy picks one, the first page of the set that may be replaced is taken instead
+		page_pinned = Array(Signal(name="page_pinned") for i in range(npagesincache))
+		assert(partitions is None or (nports > 1 and len(partitions) == nports))
+		if pinning or partitions is not None:
+			policy_victim = pg_to_replace
+			pg_to_replace = Signal(page_adr_nbits)
+			replaceable = Array(Signal(name="replaceable") for i in range(npagesincache))
+			port_ways = Signal(nways)
+			if partitions is not None:
+				self.comb += port_ways.eq(Array(C(mask, nways) for mask in partitions)[port_grant])
+			else:
+				self.comb += port_ways.eq(2**nways - 1)
+			self.comb += [replaceable[i].eq((~page_pinned[i] | ~page_valid[i]) & port_ways[i >> set_adr_nbits]) for i in range(npagesincache)]
+
+			victim_set = [set_way_adr(replace_set if nsets > 1 else 0, w) for w in range(nways)]
+			first_replaceable = Signal(page_adr_nbits)
+			any_replaceable = Signal()
+			self.comb += any_replaceable.eq(optree("|", [replaceable[pg] for pg in victim_set]))
+			self.comb += [If(replaceable[pg], first_replaceable.eq(pg)) for pg in reversed(victim_set)]
+			self.comb += pg_to_replace.eq(Mux(replaceable[policy_victim] | ~any_replaceable, policy_victim, first_replaceable))
+		if pinning:
+			# a newly allocated page starts unpinned, pages are pinned by the hits of requests with pin raised
+			self.sync += [
+				If(policy_fill, page_pinned[policy_pg_adr].eq(0)),
+				If(policy_hit & pin_p, page_pinned[pg_adr_p].eq(1)),
+				If(self.unpin_all, *[page_pinned[i].eq(0) for i in range(npagesincache)])
+			]
+
+		self.comb += policy_pg_adr.eq(Mux(policy_fill, pg_to_replace, pg_adr_p))
+
+		# page transfer module
+		self.submodules.pagetransferrer = pagetransfer.PageTransferrer(rx0, tx0, rx1, tx1, transfer_rd_port, transfer_wr_port, c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize, npagesincache=mempages, pagesize=pagesize, sectorsize=sectorsize, wbsize=dirtysize if ndirty > 1 else sectorsize, victim_buffer=victim_buffer, nfetches=nfetches, coalesce_flush=coalesce_flush, zero_pages=zero_pages, counters=counters, push=push)
+		if coalesce_flush:
+			self.comb += self.pagetransferrer.flush_tags.eq(Cat(*[page_tags[i] for i in range(npagesincache)]))
+
+		if scratchpad_pages:
+			# direct scratchpad access uses the cache ports while page_control_fsm does not
+			self.submodules.scratchpad = Scratchpad(rd_port, wr_port, npagesincache, scratchpad_pages, pagesize=pagesize, wordsize=wordsize, ptrsize=ptrsize)
+			self.comb += self.scratchpad.enable.eq(page_control_fsm.ongoing("IDLE") & ~self.pagetransferrer.copy_busy), self.sp_ack.eq(self.scratchpad.enable)
+			self.comb += self.scratchpad.adr.eq(self.sp_adr), self.scratchpad.re.eq(self.sp_re), self.scratchpad.we.eq(self.sp_we), self.scratchpad.dat_w.eq(self.sp_dat_w)
+			self.comb += self.sp_dat_r.eq(self.scratchpad.dat_r), self.sp_valid.eq(self.scratchpad.valid)
+
 		# internal FSM signals
 
 		flush_initiated = Signal()
@@ -125,7 +576,84 @@ class Virtmem(Module):
 
 		pg_to_writeback = Signal(page_adr_nbits)
 
-		self.comb += pg_to_writeback.eq(Mux(flush_initiated, pg_to_flush, pg_to_replace))
+		# scratchpad load/store
+		sp_active = self.scratchpad.active if scratchpad_pages else Signal()
+		sp_request = Signal()
+
+		# range flush and invalidate: pages with a tag from range_first_tag to range_last_tag
+		range_first_tag = Signal(page_tag_nbits)
+		range_last_tag = Signal(page_tag_nbits)
+		range_flush = Signal()
+		range_done = Signal()
+		range_match = Signal(npagesincache)
+
+		def in_range(tag):
+			return (tag >= range_first_tag) & (tag <= range_last_tag)
+
+		def set_range(addr, nbytes):
+			return [
+				NextValue(range_first_tag, addr[page_tag_off:]),
+				NextValue(range_last_tag, (addr + nbytes - 1)[page_tag_off:])
+			]
+
+		if tag_bram:
+			# the tags are compared one set (block RAM row) at a time
+			range_set = Signal(set_adr_nbits)
+			for s in range(nsets):
+				for w in range(nways):
+					i = s | (w << set_adr_nbits)
+					self.comb += range_match[i].eq(page_valid[i] & (range_set == s) & in_range(tag_port.dat_r[w*page_tag_nbits:(w+1)*page_tag_nbits]))
+		else:
+			self.comb += [range_match[i].eq(page_valid[i] & in_range(page_tags[i])) for i in range(npagesincache)]
+
+		# with tag_bram, range states are entered through state + "_TAG", which points the tag port at range_set
+		range_tag_read = Signal()
+		range_tag_states = set()
+		def range_start(state):
+			if not tag_bram:
+				return NextState(state)
+			if state not in range_tag_states:
+				range_tag_states.add(state)
+				page_control_fsm.act(state + "_TAG",
+					range_tag_read.eq(1),
+					NextState(state)
+				)
+			return [NextValue(range_set, 0), NextState(state + "_TAG")]
+
+		# the cache has to agree with the host about the range: a load first writes back dirty cached pages of it,
+		# cached pages of a stored range are invalidated afterwards
+		sp_start = []
+		sp_loaded = []
+		if scratchpad_pages:
+			self.comb += sp_request.eq(sp_load_p | sp_store_p)
+			sp_start = [
+				self.scratchpad.start(virt_addr_p, num_words_p << byte_adr_nbits, sp_adr_p, sp_load_p),
+				set_range(virt_addr_p, num_words_p << byte_adr_nbits),
+				If(sp_load_p,
+					range_start("FLUSH_RANGE")
+				).Else(
+					NextState("SP_TRANSFER_INIT")
+				)
+			]
+			sp_loaded = NextState("SP_TRANSFER_INIT")
+
+		# eager cleaning
+		cleaning = Signal()
+		clean_needed = Signal()
+		pg_to_clean = Signal(page_adr_nbits)
+		clean_candidate = Signal(page_adr_nbits)
+		if clean_watermark is not None:
+			ndirtypages = Signal(max=npagesincache+1)
+			self.comb += ndirtypages.eq(optree("+", [page_valid[i] & page_dirty[i] for i in range(npagesincache)]))
+			self.comb += clean_needed.eq(ndirtypages > clean_watermark)
+			if nsets == 1 and replacement == "truelru":
+				# least recently used dirty page
+				lru_order = [self.replacement_policy.lru[i*page_adr_nbits:(i+1)*page_adr_nbits] for i in range(npagesincache)]
+				self.comb += [If(page_valid[pg] & page_dirty[pg], clean_candidate.eq(pg)) for pg in reversed(lru_order)]
+			else:
+				self.comb += [If(page_valid[i] & page_dirty[i], clean_candidate.eq(i)) for i in reversed(range(npagesincache))]
+
+		self.comb += pg_to_writeback.eq(Mux(cleaning, pg_to_clean, Mux(flush_initiated, pg_to_flush, pg_to_replace)))
 
 		num_retransmissions = Signal(8)
 		max_retransmissions = 1
@@ -137,16 +665,254 @@ class Virtmem(Module):
 		prev_pg_adr = Signal(page_adr_nbits)
 
 		last_word = Signal()
-		crossed_page_boundary = Signal()
+		crossed_page_boundary = Signal() # (or sector boundary)
+		sector_pg_adr = Signal(page_adr_nbits)
+
+		# write miss that does not need the old contents of the sector
+		skip_fetch = Signal()
+		if write_nofetch:
+			self.comb += skip_fetch.eq(write_enable_p & (write_only_p | ((self.virt_addr_internal[:sector_off] == 0) & (burst_end_addr - self.virt_addr_internal >= sectorsize))))
+
+		# words of the line at virt_addr_internal that belong to the request (burst_mask) and the word itself (word_mask)
+		line_words = memorywidth//wordsize
+		burst_mask = Signal(max(1, line_words))
+		word_mask = Signal(max(1, line_words))
+		if line_words > 1:
+			for i in range(line_words):
+				word_addr = Cat(C(i << byte_adr_nbits, line_adr_off), self.virt_addr_internal[line_adr_off:])
+				self.comb += burst_mask[i].eq((word_addr >= self.virt_addr_internal) & (word_addr < burst_end_addr))
+			self.comb += word_mask.eq(1 << self.virt_addr_internal[word_adr_off:word_adr_off+word_adr_nbits])
+		else:
+			self.comb += burst_mask.eq(1), word_mask.eq(1)
+
+		wide_read = wide_read and line_words > 1
+		wide_write = wide_write and line_words > 1
+		read_step = 1 << (line_adr_off if wide_read else byte_adr_nbits)
+		write_step = 1 << (line_adr_off if wide_write else byte_adr_nbits)
+
+		self.sync += self.data_read_mask.eq(burst_mask if wide_read else word_mask)
+		self.comb += self.data_read_line.eq(rd_port.dat_r)
+
+		# enabled words of the line being written (registered like data_write_p)
+		write_mask = Signal(max(1, line_words))
+		prev_write_mask = Signal(max(1, line_words))
+		self.comb += self.write_ack_mask.eq(burst_mask if wide_write else word_mask)
+		self.comb += write_mask.eq(self.write_ack_mask & self.data_write_mask) if wide_write else write_mask.eq(word_mask)
+
+		# miss status holding registers, allocated in order and serviced by mshr_fsm
+		mshr_busy = Signal()
+		mshr_match = Signal()
+		mshr_alloc = Signal()
+		mshr_alloc_tag = Signal(page_tag_nbits)
+		burst_active = Signal()
+
+		if n_mshr:
+			mshr_valid = Array(Signal(name="mshr_valid") for i in range(n_mshr))
+			mshr_tag = Array(Signal(page_tag_nbits, name="mshr_tag") for i in range(n_mshr))
+			mshr_pg_adr = Array(Signal(page_adr_nbits, name="mshr_pg_adr") for i in range(n_mshr))
+			mshr_head = Signal(max=max(2, n_mshr))
+			mshr_tail = Signal(max=max(2, n_mshr))
+			page_pending = Array(Signal(name="page_pending") for i in range(npagesincache))
+
+			self.comb += mshr_busy.eq(optree("|", [mshr_valid[i] for i in range(n_mshr)]))
+			self.comb += mshr_match.eq(optree("|", [mshr_valid[i] & (mshr_tag[i] == self.virt_addr_internal[page_tag_off:]) for i in range(n_mshr)]))
+
+			# the page being replaced becomes most recently used so the next miss picks another victim
+			self.comb += If(mshr_alloc, policy_hit.eq(1), policy_fill.eq(1))
+
+			self.sync += If(mshr_alloc,
+				mshr_valid[mshr_tail].eq(1),
+				mshr_tag[mshr_tail].eq(mshr_alloc_tag),
+				mshr_pg_adr[mshr_tail].eq(pg_to_replace),
+				mshr_tail.eq(Mux(mshr_tail == n_mshr - 1, 0, mshr_tail + 1)),
+				page_valid[pg_to_replace].eq(0),
+				page_pending[pg_to_replace].eq(1)
+			)
+
+			mshr_fsm = FSM()
+			self.submodules += mshr_fsm
+
+			# the oldest MSHR completes once its page has arrived (assign is NextValue inside mshr_fsm)
+			def mshr_complete(assign=lambda target, value: target.eq(value)):
+				return [
+					assign(page_valid[mshr_pg_adr[mshr_head]], 1),
+					assign(page_pending[mshr_pg_adr[mshr_head]], 0),
+					assign(mshr_valid[mshr_head], 0),
+					assign(mshr_head, Mux(mshr_head == n_mshr - 1, 0, mshr_head + 1))
+				]
+
+			if nfetches > 1:
+				# fetches are issued in order at mshr_issue, ahead of the pages arriving at mshr_head
+				mshr_issue = Signal(max=max(2, n_mshr))
+				mshr_issued = Array(Signal(name="mshr_issued") for i in range(n_mshr))
+				mshr_to_issue = mshr_valid[mshr_issue] & ~mshr_issued[mshr_issue]
+				self.sync += If(self.pagetransferrer.fetch_done,
+					mshr_complete(),
+					mshr_issued[mshr_head].eq(0)
+				)
+			else:
+				mshr_issue = mshr_head
+				mshr_to_issue = mshr_valid[mshr_head]
+
+			mshr_fsm.act("IDLE",
+				If(mshr_to_issue,
+					If(page_dirty[mshr_pg_adr[mshr_issue]],
+						NextState("PAGE_WB_INIT")
+					).Else(
+						NextState("PAGE_FETCH_INIT")
+					)
+				)
+			)
+			mshr_fsm.act("PAGE_WB_INIT",
+				self.pagetransferrer.virt_addr.eq(0),
+				self.pagetransferrer.virt_addr[page_tag_off:].eq(page_tags[mshr_pg_adr[mshr_issue]]),
+				self.pagetransferrer.page_addr.eq(mshr_pg_adr[mshr_issue]),
+				writeback_mask(mshr_pg_adr[mshr_issue]),
+				self.pagetransferrer.send_req.eq(1),
+				NextState("PAGE_WB_WAIT")
+			)
+			mshr_fsm.act("PAGE_WB_WAIT",
+				If(self.pagetransferrer.req_complete,
+					clear_dirty(mshr_pg_adr[mshr_issue]),
+					NextState("PAGE_FETCH_INIT")
+				)
+			)
+			mshr_fsm.act("PAGE_FETCH_INIT",
+				self.pagetransferrer.virt_addr.eq(0),
+				self.pagetransferrer.virt_addr[page_tag_off:].eq(mshr_tag[mshr_issue]),
+				self.pagetransferrer.page_addr.eq(mshr_pg_adr[mshr_issue]),
+				self.pagetransferrer.fetch_req.eq(1),
+				NextValue(page_tags[mshr_pg_adr[mshr_issue]], mshr_tag[mshr_issue]),
+				NextState("PAGE_FETCH_WAIT")
+			)
+			if nfetches > 1:
+				mshr_fsm.act("PAGE_FETCH_WAIT", # fetch command sent
+					If(self.pagetransferrer.req_complete,
+						NextValue(mshr_issued[mshr_issue], 1),
+						NextValue(mshr_issue, Mux(mshr_issue == n_mshr - 1, 0, mshr_issue + 1)),
+						NextState("IDLE")
+					)
+				)
+			else:
+				mshr_fsm.act("PAGE_FETCH_WAIT",
+					If(self.pagetransferrer.req_complete,
+						mshr_complete(NextValue),
+						NextState("IDLE")
+					)
+				)
+
+		# prefetching: allocate pf_count pages starting at pf_tag
+		# (only while serving hits, so no demand miss or flush is running)
+		if pf_depth:
+			pf_tag = Signal(page_tag_nbits)
+			pf_count = Signal(max=pf_depth+1)
+			pf_active = Signal()
+			pf_allowed = Signal()
+			pf_found = Signal()
+			pf_pg_adr = Signal(page_adr_nbits)
+			pf_pending = Signal()
+			pf_skip = Signal()
+			pf_issue = Signal()
+
+			# prefetched pages that have not been accessed yet
+			page_prefetched = Array(Signal(name="page_prefetched") for i in range(npagesincache))
+
+			self.comb += page_lookup(pf_tag, pf_found, pf_pg_adr)
+			self.comb += pf_pending.eq(optree("|", [mshr_valid[i] & (mshr_tag[i] == pf_tag) for i in range(n_mshr)]))
+			self.comb += pf_active.eq(pf_count != 0)
+			self.comb += pf_allowed.eq(optree("|", [page_control_fsm.ongoing(state) for state in ["GET_DATA", "SERVE_DATA", "WRITE_DATA", "WRITE_DATA_2", "DONE"]]) & ~(found_p & cache_hit_en))
+			if nsets > 1:
+				self.comb += If(pf_active & pf_allowed, replace_set.eq(pf_tag[:set_adr_nbits]))
+
+			self.comb += If(pf_active & pf_allowed,
+				If(pf_found | pf_pending,
+					pf_skip.eq(1)
+				).Elif(~mshr_valid[mshr_tail] & ~page_pending[pg_to_replace] & (pg_to_replace != pg_adr_p), # never evict the page in use
+					pf_issue.eq(1),
+					mshr_alloc.eq(1),
+					mshr_alloc_tag.eq(pf_tag)
+				)
+			)
+			self.sync += If(pf_skip | pf_issue, pf_tag.eq(pf_tag + 1), pf_count.eq(pf_count - 1))
+
+			# prefetch statistics
+			self.sync += If(pf_issue, self.prefetch_issued.eq(self.prefetch_issued + 1))
+			self.sync += If(mshr_alloc,
+				page_prefetched[pg_to_replace].eq(pf_issue),
+				If(page_prefetched[pg_to_replace], self.prefetch_useless.eq(self.prefetch_useless + 1))
+			)
+			self.sync += If(found_p & cache_hit_en & page_prefetched[pg_adr_p],
+				page_prefetched[pg_adr_p].eq(0),
+				self.prefetch_useful.eq(self.prefetch_useful + 1)
+			)
+
+		# sequential prefetcher: when the kernel moves on to the page following the previous one,
+		# prefetch the next prefetch_depth pages too
+		if prefetch_depth:
+			last_tag = Signal(page_tag_nbits)
+			cur_tag = Signal(page_tag_nbits)
+			self.comb += cur_tag.eq(self.virt_addr_internal[page_tag_off:])
+
+			self.sync += If(cur_tag != last_tag,
+				last_tag.eq(cur_tag),
+				If(cur_tag == last_tag + 1,
+					pf_tag.eq(cur_tag + 1),
+					pf_count.eq(prefetch_depth)
+				)
+			)
+
+		# stride prefetcher: remembers the last address and stride of each request stream,
+		# once the same stride is seen twice in a row the page stride_distance strides ahead is prefetched
+		if nstreams:
+			stream_last_addr = Array(Signal(ptrsize, name="stream_last_addr") for i in range(nstreams))
+			stream_stride = Array(Signal(ptrsize, name="stream_stride") for i in range(nstreams))
+			new_stride = Signal(ptrsize)
+			stride_target = Signal(ptrsize)
+
+			self.comb += new_stride.eq(virt_addr_p - stream_last_addr[stream_id_p])
+			self.comb += stride_target.eq(virt_addr_p + stream_stride[stream_id_p]*stride_distance)
+
+			# retried requests (non-blocking mode) have the same address and are ignored
+			self.sync += If(page_control_fsm.ongoing("IDLE") & req_p & (virt_addr_p != stream_last_addr[stream_id_p]),
+				stream_last_addr[stream_id_p].eq(virt_addr_p),
+				stream_stride[stream_id_p].eq(new_stride),
+				If((new_stride == stream_stride[stream_id_p]) & (stride_target[page_tag_off:] != virt_addr_p[page_tag_off:]),
+					pf_tag.eq(stride_target[page_tag_off:]),
+					pf_count.eq(1)
+				)
+			)
+
+		def handle_miss():
+			if n_mshr:
+				return NextState("MISS")
+			elif nsectors > 1:
+				return If(page_found_p,
+					NextValue(sector_pg_adr, pg_adr_p),
+					NextState("SECTOR_FETCH_INIT")
+				).Elif(page_dirty[pg_to_replace],
+					NextState(wb_init)
+				).Else(
+					NextState("PAGE_FETCH_INIT")
+				)
+			else:
+				return If(page_dirty[pg_to_replace],
+					NextState(wb_init)
+				).Else(
+					NextState("PAGE_FETCH_INIT")
+				)
 
 		page_control_fsm.act("IDLE", #0
 			#reset internal registers
 			NextValue(num_retransmissions, 0),
+			NextValue(burst_active, 0),
 			lookup_virt_addr.eq(self.virt_addr),
 			# react to inputs
 			If(req_p,
 				NextValue(self.virt_addr_internal, virt_addr_p),
-				NextValue(next_virt_addr, virt_addr_p + (1 << byte_adr_nbits)),
+				# wide bursts continue at the next line
+				NextValue(next_virt_addr, Mux(write_enable_p,
+					(virt_addr_p | ((1 << line_adr_off) - 1)) + 1 if wide_write else virt_addr_p + (1 << byte_adr_nbits),
+					(virt_addr_p | ((1 << line_adr_off) - 1)) + 1 if wide_read else virt_addr_p + (1 << byte_adr_nbits))),
 				NextValue(burst_end_addr, virt_addr_p + (num_words_p << byte_adr_nbits)),
 				If(found_p,
 					If(write_enable_p,
@@ -155,16 +921,24 @@ class Virtmem(Module):
 						NextState("GET_DATA")
 					)
 				).Else(
-					If(page_dirty[pg_to_replace],
-						NextState("PAGE_WB_INIT")
-					).Else(
-						NextState("PAGE_FETCH_INIT")
-					)
+					handle_miss()
 				)
-			).Elif(flush_all_p,
+			).Elif(flush_all_p & ~mshr_busy,
 				NextState("FLUSH_DIRTY")
-			).Elif(cmd_rx_transaction_requested,
+			).Elif(flush_range_p & ~mshr_busy,
+				set_range(virt_addr_p, num_words_p << byte_adr_nbits),
+				range_start("FLUSH_RANGE")
+			).Elif(invalidate_range_p & ~mshr_busy,
+				set_range(virt_addr_p, num_words_p << byte_adr_nbits),
+				range_start("INVALIDATE_RANGE")
+			).Elif(sp_request,
+				sp_start
+			).Elif(cmd_rx_transaction_requested & ~mshr_busy,
 				NextState("RX_CMD")
+			).Elif(clean_needed & ~mshr_busy,
+				NextValue(cleaning, 1),
+				NextValue(pg_to_clean, clean_candidate),
+				NextState(wb_init)
 			)
 		)
 
@@ -174,11 +948,12 @@ class Virtmem(Module):
 			rd_port.adr.eq(Cat(self.virt_addr_internal[line_adr_off:line_adr_off + line_adr_nbits], pg_adr_p)),
 			rd_port.re.eq(1),
 			NextValue(word_select, self.virt_addr_internal[word_adr_off:word_adr_off+word_adr_nbits]),
+			NextValue(burst_active, 1),
 			self.data_valid_n.eq(1),
 			NextValue(self.virt_addr_internal, next_virt_addr),
-			NextValue(next_virt_addr, next_virt_addr + (1 << byte_adr_nbits)),
+			NextValue(next_virt_addr, next_virt_addr + read_step),
 			NextValue(last_word, next_virt_addr >= burst_end_addr),
-			NextValue(crossed_page_boundary, self.virt_addr_internal[page_tag_off:] != next_virt_addr[page_tag_off:]),
+			NextValue(crossed_page_boundary, self.virt_addr_internal[sector_off:] != next_virt_addr[sector_off:]),
 			NextState("SERVE_DATA")
 		)
 		page_control_fsm.act("SERVE_DATA", #2
@@ -193,19 +968,15 @@ class Virtmem(Module):
 					rd_port.re.eq(1),
 					NextValue(word_select, self.virt_addr_internal[word_adr_off:word_adr_off+word_adr_nbits]),
 					NextValue(self.virt_addr_internal, next_virt_addr),
-					NextValue(next_virt_addr, next_virt_addr + (1 << byte_adr_nbits)),
+					NextValue(next_virt_addr, next_virt_addr + read_step),
 					NextValue(last_word, next_virt_addr >= burst_end_addr),
-					NextValue(crossed_page_boundary, self.virt_addr_internal[page_tag_off:] != next_virt_addr[page_tag_off:]),
+					NextValue(crossed_page_boundary, self.virt_addr_internal[sector_off:] != next_virt_addr[sector_off:]),
 					self.data_valid_n.eq(1),
 				).Else(
 					If(found_p,
 						NextState("GET_DATA")
 					).Else(
-						If(page_dirty[pg_to_replace],
-							NextState("PAGE_WB_INIT")
-						).Else(
-							NextState("PAGE_FETCH_INIT")
-						)
+						handle_miss()
 					)
 				)
 			).Else(
@@ -216,20 +987,24 @@ class Virtmem(Module):
 			lookup_virt_addr.eq(next_virt_addr),
 			self.write_ack.eq(1),
 			cache_hit_en.eq(1),
-			NextValue(page_dirty[pg_adr_p], 1),
+			set_dirty(pg_adr_p, self.virt_addr_internal),
 			NextValue(prev_virt_addr, self.virt_addr_internal),
 			NextValue(prev_pg_adr, pg_adr_p),
+			NextValue(prev_write_mask, write_mask),
 			NextValue(self.virt_addr_internal, next_virt_addr),
-			NextValue(next_virt_addr, next_virt_addr + (1 << byte_adr_nbits)),
+			NextValue(next_virt_addr, next_virt_addr + write_step),
 			NextValue(last_word, next_virt_addr >= burst_end_addr),
+			NextValue(burst_active, 1),
 			NextState("WRITE_DATA_2")
 		)
 		page_control_fsm.act("WRITE_DATA_2", #4
 			lookup_virt_addr.eq(next_virt_addr),
+			wr_port.dat_w.eq(data_write_line_p)
+			if wide_write else
 			wr_port.dat_w.eq(Cat([data_write_p for i in range(words_per_line)]))
 			if c_pci_data_width > wordsize else
 			wr_port.dat_w.eq(data_write_p),
-			wr_port.we.eq(1 << prev_virt_addr[word_adr_off:word_adr_off+word_adr_nbits])
+			wr_port.we.eq(prev_write_mask)
 			if c_pci_data_width > wordsize else
 			[wr_port.we[i].eq(1) for i in range(words_per_line)],
 			wr_port.adr.eq(Cat(prev_virt_addr[line_adr_off:line_adr_off + line_adr_nbits], prev_pg_adr)),
@@ -238,18 +1013,15 @@ class Virtmem(Module):
 				If(found_p,
 					self.write_ack.eq(1),
 					cache_hit_en.eq(1),
-					NextValue(page_dirty[pg_adr_p], 1),
+					set_dirty(pg_adr_p, self.virt_addr_internal),
 					NextValue(prev_virt_addr, self.virt_addr_internal),
 					NextValue(prev_pg_adr, pg_adr_p),
+					NextValue(prev_write_mask, write_mask),
 					NextValue(self.virt_addr_internal, next_virt_addr),
 					NextValue(last_word, next_virt_addr >= burst_end_addr),
-					NextValue(next_virt_addr, next_virt_addr + (1 << byte_adr_nbits))
+					NextValue(next_virt_addr, next_virt_addr + write_step)
 				).Else(
-					If(page_dirty[pg_to_replace],
-						NextState("PAGE_WB_INIT")
-					).Else(
-						NextState("PAGE_FETCH_INIT")
-					)
+					handle_miss()
 				)	
 			).Else(
 				NextState("DONE")
@@ -257,18 +1029,65 @@ class Virtmem(Module):
 		)
 
 
-		page_control_fsm.act("PAGE_FETCH_INIT", #5
+		if n_mshr:
+			page_control_fsm.act("MISS", # wait one cycle for the lookup of virt_addr_internal
+				lookup_virt_addr.eq(self.virt_addr_internal),
+				NextState("MISS_ALLOC")
+			)
+			page_control_fsm.act("MISS_ALLOC",
+				lookup_virt_addr.eq(self.virt_addr_internal),
+				If(found_p, # page arrived in the meantime
+					If(write_enable_p,
+						NextState("WRITE_DATA")
+					).Else(
+						NextState("GET_DATA")
+					)
+				).Else(
+					# found: the page may have been filled this cycle, after found_p was registered
+					If(~found & ~mshr_match & ~mshr_valid[mshr_tail] & ~page_pending[pg_to_replace],
+						mshr_alloc.eq(1),
+						mshr_alloc_tag.eq(self.virt_addr_internal[page_tag_off:])
+					),
+					If(~burst_active,
+						self.done.eq(1),
+						self.miss.eq(1),
+						NextState("IDLE")
+					) if nmshr else []
+				)
+			)
+
+		page_fetch = [
 			self.pagetransferrer.virt_addr.eq(0),
-			self.pagetransferrer.virt_addr[page_tag_off:].eq(self.virt_addr_internal[page_tag_off:]),
+			self.pagetransferrer.virt_addr[sector_off:].eq(self.virt_addr_internal[sector_off:]),
 			self.pagetransferrer.page_addr.eq(pg_to_replace),
 			self.pagetransferrer.fetch_req.eq(1),
 			NextState("PAGE_FETCH_WAIT")
+		]
+		page_control_fsm.act("PAGE_FETCH_INIT", #5
+			If(skip_fetch,
+				set_tag(pg_to_replace, self.virt_addr_internal[page_tag_off:]),
+				NextValue(page_valid[pg_to_replace], 1),
+				NextValue(page_sectors[pg_to_replace], 1 << self.virt_addr_internal[sector_off:page_tag_off]) if nsectors > 1 else [],
+				NextState("PAGE_ALLOC")
+			).Else(*page_fetch)
+			if write_nofetch else
+			page_fetch
 		)
+		if write_nofetch:
+			page_control_fsm.act("PAGE_ALLOC", # wait one cycle for the lookup of the allocated page (and for the victim copy)
+				lookup_virt_addr.eq(self.virt_addr_internal),
+				If(~self.pagetransferrer.copy_busy,
+					policy_fill.eq(1),
+					NextState("WRITE_DATA")
+				)
+			)
 		page_control_fsm.act("PAGE_FETCH_WAIT", #6
 			lookup_virt_addr.eq(self.virt_addr_internal),
-			NextValue(page_tags[pg_to_replace], self.virt_addr_internal[page_tag_off:]),
+			set_tag(pg_to_replace, self.virt_addr_internal[page_tag_off:]),
 			NextValue(page_valid[pg_to_replace], 1),
+			NextValue(page_sectors[pg_to_replace], 1 << self.virt_addr_internal[sector_off:page_tag_off]) if nsectors > 1 else [],
 			If(self.pagetransferrer.req_complete,
+				policy_fill.eq(1),
 				If(write_enable_p,
 					NextState("WRITE_DATA")
 				).Else(
@@ -277,42 +1096,253 @@ class Virtmem(Module):
 			)
 		)
 
+		if nsectors > 1:
+			# the page is present, only fill in the missing sector
+			sector_fetch = [
+				self.pagetransferrer.virt_addr.eq(0),
+				self.pagetransferrer.virt_addr[sector_off:].eq(self.virt_addr_internal[sector_off:]),
+				self.pagetransferrer.page_addr.eq(sector_pg_adr),
+				self.pagetransferrer.fetch_req.eq(1),
+				NextState("SECTOR_FETCH_WAIT")
+			]
+			page_control_fsm.act("SECTOR_FETCH_INIT",
+				If(skip_fetch,
+					NextValue(page_sectors[sector_pg_adr], page_sectors[sector_pg_adr] | (1 << self.virt_addr_internal[sector_off:page_tag_off])),
+					NextState("PAGE_ALLOC")
+				).Else(*sector_fetch)
+				if write_nofetch else
+				sector_fetch
+			)
+			page_control_fsm.act("SECTOR_FETCH_WAIT",
+				lookup_virt_addr.eq(self.virt_addr_internal),
+				# mark the sector present early (like PAGE_FETCH_WAIT does with the page) so the lookup finds it when serving the request
+				NextValue(page_sectors[sector_pg_adr], page_sectors[sector_pg_adr] | (1 << self.virt_addr_internal[sector_off:page_tag_off])),
+				If(self.pagetransferrer.req_complete,
+					If(write_enable_p,
+						NextState("WRITE_DATA")
+					).Else(
+						NextState("GET_DATA")
+					)
+				)
+			)
+
+		if tag_bram:
+			self.comb += tag_wb_pg.eq(Mux(range_tag_read, range_set, pg_to_writeback))
+			page_control_fsm.act("PAGE_WB_TAG",
+				NextState("PAGE_WB_INIT")
+			)
 		page_control_fsm.act("PAGE_WB_INIT",
 			self.pagetransferrer.virt_addr.eq(0),
-			self.pagetransferrer.virt_addr[page_tag_off:].eq(page_tags[pg_to_writeback]),
+			self.pagetransferrer.virt_addr[page_tag_off:].eq(writeback_tag(pg_to_writeback)),
 			self.pagetransferrer.page_addr.eq(pg_to_writeback),
+			writeback_mask(pg_to_writeback),
 			self.pagetransferrer.send_req.eq(1),
 			NextState("PAGE_WB_WAIT")
 		)
 		page_control_fsm.act("PAGE_WB_WAIT",
-			If(self.pagetransferrer.req_complete,
-				NextValue(page_dirty[pg_to_writeback], 0),
+			If(cleaning,
+				# the page stays in the cache, wait until it has been copied out when using a victim buffer
+				# look up the kernel input like IDLE does so a request waiting meanwhile sees a valid found_p
+				lookup_virt_addr.eq(self.virt_addr),
+				If(self.pagetransferrer.req_complete & ~self.pagetransferrer.copy_busy,
+					clear_dirty(pg_to_writeback),
+					NextValue(cleaning, 0),
+					NextState("IDLE")
+				)
+			).Elif(self.pagetransferrer.req_complete,
+				clear_dirty(pg_to_writeback),
 				NextValue(page_valid[pg_to_writeback], 0),
 				If(flush_initiated,
-					NextState("FLUSH_DIRTY")
+					If(range_flush,
+						NextState("FLUSH_RANGE_TAG" if tag_bram else "FLUSH_RANGE")
+					).Else(
+						NextState("FLUSH_DIRTY")
+					)
 				).Else(
 					NextState("PAGE_FETCH_INIT")
 				)
 			)
 		)
 
+		if coalesce_flush:
+			# all dirty pages are sent at once
+			flush_mask = Signal(npagesincache)
+			self.comb += flush_mask.eq(Cat(*[page_valid[i] & page_dirty[i] for i in range(npagesincache)]))
+			page_control_fsm.act("FLUSH_COALESCED",
+				self.pagetransferrer.flush_mask.eq(flush_mask),
+				self.pagetransferrer.flush_req.eq(1),
+				NextState("FLUSH_COALESCED_WAIT")
+			)
+			page_control_fsm.act("FLUSH_COALESCED_WAIT",
+				If(self.pagetransferrer.req_complete,
+					[If(flush_mask[i], clear_dirty(i), NextValue(page_valid[i], 0)) for i in range(npagesincache)],
+					NextState("FLUSH_DIRTY")
+				)
+			)
 		page_control_fsm.act("FLUSH_DIRTY", #1
 			NextValue(flush_initiated, 1),
 			flush_done.eq(1),
 			[If(page_valid[i] & page_dirty[i], NextValue(pg_to_flush, i), flush_done.eq(0)) for i in range(npagesincache)],
 			If(flush_done,
 				#[NextValue(page_valid[i], 0) for i in range(npagesincache)],
-				NextValue(flush_initiated, 0),
-				If(flush_all_p, 
-					NextState("DONE")
-				).Else(
-					NextState("TX_FLUSH_DONE")
+				If(~self.pagetransferrer.wb_busy, # background writeback finished
+					NextValue(flush_initiated, 0),
+					If(flush_all_p, 
+						NextState("DONE")
+					).Else(
+						NextState("TX_FLUSH_DONE")
+					)
 				)
 			).Else(
-				NextState("PAGE_WB_INIT")
+				NextState("FLUSH_COALESCED" if coalesce_flush else wb_init)
 			)
 		)
-		
+
+		# with tag_bram, continue with the next set once no page of this one is left
+		def range_next_set(state, finish):
+			if tag_bram:
+				return If(range_set != nsets - 1,
+					NextValue(range_set, range_set + 1),
+					NextState(state + "_TAG")
+				).Else(*finish)
+			else:
+				return finish
+
+		page_control_fsm.act("FLUSH_RANGE",
+			NextValue(flush_initiated, 1),
+			NextValue(range_flush, 1),
+			range_done.eq(1),
+			[If(range_match[i] & page_dirty[i], NextValue(pg_to_flush, i), range_done.eq(0)) for i in range(npagesincache)],
+			If(range_done,
+				range_next_set("FLUSH_RANGE", [
+					If(~self.pagetransferrer.wb_busy,
+						NextValue(flush_initiated, 0),
+						NextValue(range_flush, 0),
+						If(sp_active,
+							sp_loaded
+						).Elif(flush_range_p,
+							NextState("DONE")
+						).Else(
+							NextState("TX_FLUSH_DONE")
+						)
+					)
+				])
+			).Else(
+				NextState(wb_init)
+			)
+		)
+		page_control_fsm.act("INVALIDATE_RANGE",
+			[If(range_match[i], NextValue(page_valid[i], 0), clear_dirty(i)) for i in range(npagesincache)],
+			range_next_set("INVALIDATE_RANGE", [NextState("INVALIDATE_RANGE_DONE")])
+		)
+		page_control_fsm.act("INVALIDATE_RANGE_DONE", # look up the kernel input again now that the pages are invalid
+			lookup_virt_addr.eq(self.virt_addr),
+			If(invalidate_range_p | sp_active,
+				NextValue(sp_active, 0),
+				NextState("DONE")
+			).Else(
+				NextState("IDLE")
+			)
+		)
+
+		if pinning:
+			page_control_fsm.act("PIN_RANGE",
+				[If(range_match[i], NextValue(page_pinned[i], 1)) for i in range(npagesincache)],
+				range_next_set("PIN_RANGE", [NextState("PIN_RANGE_DONE")])
+			)
+			page_control_fsm.act("UNPIN_RANGE",
+				[If(range_match[i], NextValue(page_pinned[i], 0)) for i in range(npagesincache)],
+				range_next_set("UNPIN_RANGE", [NextState("PIN_RANGE_DONE")])
+			)
+			page_control_fsm.act("PIN_RANGE_DONE",
+				lookup_virt_addr.eq(self.virt_addr),
+				NextState("IDLE")
+			)
+
+		# commands are up to 128 bits, range commands use all of them
+		cmd_beats = 128//c_pci_data_width
+		cmd_data = Signal(128)
+		cmd_beat = [Signal(c_pci_data_width, name="cmd_beat") for i in range(cmd_beats)]
+		self.comb += cmd_data.eq(Cat(*cmd_beat))
+
+		rx_cmd_decode = If(self.cmd_rx.data[0:32] == 0xF1005,
+				NextState("FLUSH_DIRTY")
+			).Elif(self.cmd_rx.data[0:32] == 0xC105E,
+				NextState("INVALIDATE_ALL_PAGES")
+			).Elif((self.cmd_rx.data[0:32] == 0xAF1005) | (self.cmd_rx.data[0:32] == 0xAC105E),
+				NextState("RX_CMD1" if cmd_beats > 1 else "RANGE_CMD")
+			)
+		if pinning:
+			rx_cmd_decode.Elif((self.cmd_rx.data[0:32] == 0xAB10C) | (self.cmd_rx.data[0:32] == 0xAF2EE),
+				NextState("RX_CMD1" if cmd_beats > 1 else "RANGE_CMD")
+			)
+		if push:
+			rx_cmd_decode.Elif(self.cmd_rx.data[0:32] == 0x9054,
+				NextState("RX_CMD1" if cmd_beats > 1 else "RANGE_CMD")
+			)
+
+		if counters:
+			# performance counters, sent to the host in this order
+			miss_states = ["PAGE_FETCH_INIT", "PAGE_FETCH_WAIT"]
+			miss_states += ["PAGE_ALLOC"] if write_nofetch else []
+			miss_states += ["SECTOR_FETCH_INIT", "SECTOR_FETCH_WAIT"] if nsectors > 1 else []
+			miss_states += ["MISS", "MISS_ALLOC"] if n_mshr else []
+			wb_states = ["PAGE_WB_INIT", "PAGE_WB_WAIT"]
+			wb_states += ["PAGE_WB_TAG"] if tag_bram else []
+			wb_states += ["FLUSH_COALESCED", "FLUSH_COALESCED_WAIT"] if coalesce_flush else []
+			miss_entered = optree("|", [page_control_fsm.before_entering(state) for state in ["PAGE_FETCH_INIT"] + (["SECTOR_FETCH_INIT"] if nsectors > 1 else []) + (["MISS"] if n_mshr else [])])
+			dirty_eviction = page_control_fsm.ongoing("PAGE_WB_INIT") & ~cleaning & ~flush_initiated
+			if n_mshr:
+				dirty_eviction = dirty_eviction | mshr_fsm.ongoing("PAGE_WB_INIT")
+			counter_events = [
+				("cycles", C(1)),
+				("idle_cycles", page_control_fsm.ongoing("IDLE") & ~req_p),
+				("hits", found_p & cache_hit_en), # words served from the cache
+				("misses", miss_entered),
+				("dirty_evictions", dirty_eviction),
+				("prefetches", pf_issue if pf_depth else C(0)),
+				("miss_cycles", optree("|", [page_control_fsm.ongoing(state) for state in miss_states])), # waiting for a page
+				("writeback_cycles", optree("|", [page_control_fsm.ongoing(state) for state in wb_states]))
+			]
+			for name, event in counter_events:
+				counter = Signal(32, name="counter_" + name)
+				self.sync += If(event, counter.eq(counter + 1))
+				self.counters.append(counter)
+			self.counters += [self.pagetransferrer.fetches, self.pagetransferrer.writebacks, self.pagetransferrer.words_received, self.pagetransferrer.words_sent, self.pagetransferrer.host_wait_cycles]
+
+			# the snapshot is taken when the command arrives
+			counter_words = (4 + len(self.counters) + 3)//4*4
+			counter_beats = counter_words*32//c_pci_data_width
+			counter_snapshot = Signal(counter_words*32)
+			counter_beat = Signal(max=max(2, counter_beats))
+			rx_cmd_decode.Elif(self.cmd_rx.data[0:32] == 0x57A75,
+				NextValue(counter_snapshot, Cat(C(len(self.counters), 32), C(0, 32), C(0x57A757A757A757A7, 64), *self.counters)),
+				NextState("TX_COUNTERS")
+			)
+			page_control_fsm.act("TX_COUNTERS",
+				NextValue(counter_beat, 0),
+				If(~self.pagetransferrer.wb_busy, # cmd_tx is free once the background writeback has finished
+					self.cmd_tx.start.eq(1),
+					self.cmd_tx.len.eq(counter_words),
+					self.cmd_tx.last.eq(1),
+					If(self.cmd_tx.ack,
+						NextState("TX_COUNTERS_DATA")
+					)
+				)
+			)
+			page_control_fsm.act("TX_COUNTERS_DATA",
+				self.cmd_tx.start.eq(1),
+				self.cmd_tx.len.eq(counter_words),
+				self.cmd_tx.last.eq(1),
+				self.cmd_tx.data.eq(Array(counter_snapshot[i*c_pci_data_width:(i+1)*c_pci_data_width] for i in range(counter_beats))[counter_beat]),
+				self.cmd_tx.data_valid.eq(1),
+				If(self.cmd_tx.data_ren,
+					NextValue(counter_beat, counter_beat + 1),
+					If(counter_beat == counter_beats - 1,
+						NextState("IDLE")
+					)
+				)
+			)
 
 		page_control_fsm.act("RX_CMD", #13
 			lookup_virt_addr.eq(self.virt_addr_internal),
@@ -320,13 +1350,44 @@ class Virtmem(Module):
 			cmd_rx_transaction_ack.eq(1),
 			If(self.cmd_rx.data_valid,
 				self.cmd_rx.data_ren.eq(1),
-				If(self.cmd_rx.data[0:32] == 0xF1005,
-					NextState("FLUSH_DIRTY")
-				).Elif(self.cmd_rx.data[0:32] == 0xC105E,
-					NextState("INVALIDATE_ALL_PAGES")
+				NextValue(cmd_beat[0], self.cmd_rx.data),
+				rx_cmd_decode
+			)
+		)
+		for i in range(1, cmd_beats):
+			page_control_fsm.act("RX_CMD" + str(i),
+				If(self.cmd_rx.data_valid,
+					self.cmd_rx.data_ren.eq(1),
+					NextValue(cmd_beat[i], self.cmd_rx.data),
+					NextState("RX_CMD" + str(i+1) if i+1 < cmd_beats else "RANGE_CMD")
 				)
 			)
+		range_cmd_decode = If(cmd_data[0:32] == 0xAF1005,
+				range_start("FLUSH_RANGE")
+			).Elif(cmd_data[0:32] == 0xAC105E,
+				range_start("INVALIDATE_RANGE")
+			)
+		if pinning:
+			range_cmd_decode.Elif(cmd_data[0:32] == 0xAB10C,
+				range_start("PIN_RANGE")
+			).Elif(cmd_data[0:32] == 0xAF2EE,
+				range_start("UNPIN_RANGE")
+			)
+		if push:
+			range_cmd_decode.Elif(cmd_data[0:32] == 0x9054,
+				NextValue(self.virt_addr_internal, cmd_data[64:64+ptrsize]),
+				NextState("PUSH_LOOKUP")
+			)
+		page_control_fsm.act("RANGE_CMD", # [magic, length in bytes, address]
+			set_range(cmd_data[64:64+ptrsize], cmd_data[32:64]),
+			range_cmd_decode
 		)
+
+		if push:
+			self.add_push_states(page_control_fsm, lookup_virt_addr, found_p, pg_to_replace,
+				victim_dirty=page_valid[pg_to_replace] & page_dirty[pg_to_replace],
+				allocate=[set_tag(pg_to_replace, self.virt_addr_internal[page_tag_off:]), NextValue(page_valid[pg_to_replace], 1), clear_dirty(pg_to_replace)],
+				policy_update=[policy_hit.eq(1), policy_fill.eq(1)])
 		flush_done_cmd = Signal(128)
 		self.comb += flush_done_cmd[64:128].eq(0xD1DF1005D1DF1005)
 		page_control_fsm.act("TX_FLUSH_DONE", #14
@@ -364,14 +1425,54 @@ class Virtmem(Module):
 			NextState("IDLE")
 		)
 
+		if scratchpad_pages:
+			# one page at a time between virtual memory and the scratchpad pages of the block RAM
+			self.scratchpad.add_transfer_states(page_control_fsm, self.pagetransferrer, NextState("DONE"), range_start("INVALIDATE_RANGE"))
+
+	# states of fsm for a page pushed by the host to virt_addr_internal: the page goes to pg_to_replace, where a miss on its address would put it,
+	# its data follows the command; it is dropped if it is resident (found_p) or the slot holds a dirty page (victim_dirty),
+	# allocate are the actions that make it resident and policy_update those that mark it used
+	def add_push_states(self, fsm, lookup_virt_addr, found_p, pg_to_replace, victim_dirty, allocate, policy_update):
+		push_drop = Signal()
+		push_dropped = Signal()
+		fsm.act("PUSH_LOOKUP",
+			lookup_virt_addr.eq(self.virt_addr_internal),
+			NextState("PUSH_INIT")
+		)
+		fsm.act("PUSH_INIT",
+			lookup_virt_addr.eq(self.virt_addr_internal),
+			push_drop.eq(found_p | victim_dirty),
+			self.pagetransferrer.virt_addr.eq(self.virt_addr_internal),
+			self.pagetransferrer.page_addr.eq(pg_to_replace),
+			self.pagetransferrer.push_discard.eq(push_drop),
+			self.pagetransferrer.push_req.eq(1),
+			NextValue(push_dropped, push_drop),
+			NextState("PUSH_WAIT")
+		)
+		fsm.act("PUSH_WAIT",
+			lookup_virt_addr.eq(self.virt_addr_internal),
+			If(~push_dropped,
+				allocate
+			),
+			If(self.pagetransferrer.req_complete,
+				# like an allocation by the MSHRs, the pushed page counts as used so the next push or miss replaces another one
+				If(~push_dropped, policy_update),
+				NextState("PUSH_DONE")
+			)
+		)
+		fsm.act("PUSH_DONE", # look up the kernel input again like IDLE
+			lookup_virt_addr.eq(self.virt_addr),
+			NextState("IDLE")
+		)
+
 
 class VirtmemWrapper(GenericRiffa):
-	def __init__(self, combined_interface_rx, combined_interface_tx, c_pci_data_width=32, wordsize=32, ptrsize=64, drive_clocks=True):
+	def __init__(self, combined_interface_rx, combined_interface_tx, c_pci_data_width=32, wordsize=32, ptrsize=64, drive_clocks=True, npagesincache=4, pagesize=4096, nways=None, nmshr=0, prefetch_depth=0, nstreams=0, stride_distance=2, sectorsize=None, dirtysize=None, wide_read=False, wide_write=False, nports=1, arbitration="roundrobin", write_nofetch=False, victim_buffer=False, clean_watermark=None, replacement="truelru", replacement_duel=None, tag_bram=False, nfetches=1, coalesce_flush=False, zero_pages=False, counters=False, pinning=False, partitions=None, scratchpad_pages=0, push=False):
 		GenericRiffa.__init__(self, combined_interface_rx=combined_interface_rx, combined_interface_tx=combined_interface_tx, c_pci_data_width=c_pci_data_width, drive_clocks=drive_clocks)
 
 		rx0, tx0 = self.get_channel(0)
 		rx1, tx1 = self.get_channel(1)
-		self.submodules.virtmem = Virtmem(rx0, tx0, rx1, tx1, c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize)
+		self.submodules.virtmem = Virtmem(rx0, tx0, rx1, tx1, c_pci_data_width=c_pci_data_width, wordsize=wordsize, ptrsize=ptrsize, npagesincache=npagesincache, pagesize=pagesize, nways=nways, nmshr=nmshr, prefetch_depth=prefetch_depth, nstreams=nstreams, stride_distance=stride_distance, sectorsize=sectorsize, dirtysize=dirtysize, wide_read=wide_read, wide_write=wide_write, nports=nports, arbitration=arbitration, write_nofetch=write_nofetch, victim_buffer=victim_buffer, clean_watermark=clean_watermark, replacement=replacement, replacement_duel=replacement_duel, tag_bram=tag_bram, nfetches=nfetches, coalesce_flush=coalesce_flush, zero_pages=zero_pages, counters=counters, pinning=pinning, partitions=partitions, scratchpad_pages=scratchpad_pages, push=push)
 
 def main():
 	if len(sys.argv) < 4:
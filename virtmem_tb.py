@@ -18,7 +18,8 @@ def generate_data_fn(wordsize=32):
 
 
 class TBMemory(Module):
-	def __init__(self, cmd_rx, cmd_tx, data_rx, data_tx, c_pci_data_width=32, wordsize=32, ptrsize=64, npagesincache=4, pagesize=4096, init_fn=generate_data_fn()):
+	def __init__(self, cmd_rx, cmd_tx, data_rx, data_tx, c_pci_data_width=32, wordsize=32, ptrsize=64, npagesincache=4, pagesize=4096, init_fn=generate_data_fn(), zero_pages=False):
+		# zero_pages: answer fetches of all zero pages with a single word
 		self.cmd_rx = cmd_rx
 		self.cmd_tx = cmd_tx
 		self.data_rx = data_rx
@@ -31,6 +32,13 @@ class TBMemory(Module):
 		self.modified = {}
 		self.flushack = 0
 		self.init_fn = init_fn
+		self.zero_pages = zero_pages
+		self.counters = None
+		self.fetches = 0
+		self.fetch_bytes = 0
+		self.writeback_bytes = 0
+		self.coalesced_flushes = 0
+		self.zero_writebacks = 0
 
 	def read_mem(self, addr):
 		if addr in self.modified:
@@ -44,55 +52,56 @@ class TBMemory(Module):
 			if selfp.cmd_rx.start :
 				# print("Receiving command...")
 				cmd = yield from riffa.channel_read(selfp.simulator, self.cmd_rx)
+				if cmd[2] == 0x57A757A7:
+					self.counters = cmd[4:4+cmd[0]]
+					print("Counters: " + str(self.counters))
+					continue
+				if cmd[2] == 0x61B0A110:
+					# coalesced flush: one address per cache page (all ones if not sent), then the pages sent
+					nentries, npages = cmd[0], cmd[1]
+					addrs = [riffa.pack(ret[2*i:2*i+2]) for i in range(nentries)]
+					addrs = [a for a in addrs if a != 2**64 - 1]
+					if len(addrs) != npages:
+						print("Wrong number of pages in flush: " + str(len(addrs)))
+					data = ret[2*nentries:]
+					self.coalesced_flushes += 1
+					pagewords = len(data)//npages if npages else 0
+					for i, addr in enumerate(addrs):
+						print("Writeback page " + hex(addr))
+						self.writeback_bytes += 4*pagewords
+						self.write_back(addr, data[i*pagewords:(i+1)*pagewords])
+					ret = []
+					continue
 				addr = (cmd[1] << 32) | cmd[0] if self.ptrsize > 32 else cmd[0]
-				pg_addr = (addr >> log2_int(self.pagesize)) << log2_int(self.pagesize) 
-				assert(addr == pg_addr)
+				# sector commands carry the length in 32 bit words instead of the second half of the magic
+				if cmd[3] == cmd[2]:
+					nwords = self.pagesize//4
+					pg_addr = (addr >> log2_int(self.pagesize)) << log2_int(self.pagesize) 
+					assert(addr == pg_addr)
+				else:
+					nwords = cmd[3]
+					assert(addr % 4 == 0)
 				if cmd[2] == 0x6e706e70:
-					print("Fetching page " + hex(addr))
-					data = []
-					if self.wordsize < 32:
-						mask = 1
-						for i in range(self.wordsize):
-							mask = mask | (1 << i)
-						for i in range(pg_addr, pg_addr+self.pagesize, 4):
-							d = 0
-							for j in range(0,32//self.wordsize):
-								d = d | ((self.read_mem(i+ j*(self.wordsize//8)) & mask) << j*self.wordsize)
-							data.append(d)
-					else:
-						for i in range(pg_addr, pg_addr+self.pagesize, (self.wordsize//8)):
-							data.extend(riffa.unpack(self.read_mem(i), self.wordsize//32))
-					if len(data) != self.pagesize//4:
-						print("Wrong page length: " + str(len(data)))
+					print("Fetching page " + hex(addr) + ("" if nwords == self.pagesize//4 else " ({} words)".format(nwords)))
+					data = self.page_data(addr, nwords)
+					self.fetches += 1
+					self.fetch_bytes += 4*len(data)
 					yield from riffa.channel_write(selfp.simulator, self.data_tx, data)
 					# print("Finished fetching page.")
 				if cmd[2] == 0x61B061B0:
-					print("Writeback page " + hex(addr))
+					print("Writeback page " + hex(addr) + ("" if nwords == self.pagesize//4 else " ({} words)".format(nwords)))
 					# print(ret)
-					if len(ret) < self.pagesize//4:
+					if len(ret) < nwords:
 						print("Incomplete writeback: received only " + str(len(ret)) + " words")
-					if self.wordsize >= 32:
-						words = [riffa.pack(x) for x in zip(*[ret[i::self.wordsize//32] for i in range(self.wordsize//32)])]
-					else:
-						words = []
-						mask = 1
-						for i in range(self.wordsize):
-							mask = mask | (1 << i)
-						for i in range(len(ret)):
-							for j in range(32//self.wordsize):
-								words.append((ret[i] >> j*self.wordsize) & mask)
-					print("Modified:")
-					num_modified = 0
-					for i in range(len(words)):
-						if words[i] != self.read_mem(addr+i*(self.wordsize//8)):
-							num_modified += 1
-							self.modified[addr+i*(self.wordsize//8)] = words[i]
-							if num_modified < 10:
-								print(hex(addr+i*(self.wordsize//8)) + ": " + hex(words[i]))
-					if num_modified >= 10:
-						print("and more... " + str(num_modified) + " total.")
+					self.writeback_bytes += 4*len(ret)
+					self.write_back(addr, ret)
 					ret = []
 					# print("Finished writing back page.")
+				if cmd[2] == 0x2E8061B0:
+					# only the command is sent
+					print("Zero writeback " + hex(addr) + " ({} words)".format(nwords))
+					self.zero_writebacks += 1
+					self.write_back(addr, [0]*nwords)
 				if cmd[2] == 0xD1DF1005:
 					self.flushack = 1
 					print("Cache finished flushing.")
@@ -107,6 +116,49 @@ class TBMemory(Module):
 
 	gen_simulation.passive = True
 
+	def page_data(self, addr, nwords):
+		data = []
+		if self.wordsize < 32:
+			mask = 1
+			for i in range(self.wordsize):
+				mask = mask | (1 << i)
+			for i in range(addr, addr+4*nwords, 4):
+				d = 0
+				for j in range(0,32//self.wordsize):
+					d = d | ((self.read_mem(i+ j*(self.wordsize//8)) & mask) << j*self.wordsize)
+				data.append(d)
+		else:
+			for i in range(addr, addr+4*nwords, (self.wordsize//8)):
+				data.extend(riffa.unpack(self.read_mem(i), self.wordsize//32))
+		if len(data) != nwords:
+			print("Wrong page length: " + str(len(data)))
+		if self.zero_pages and not any(data):
+			print("Zero page")
+			data = [0]
+		return data
+
+	def write_back(self, addr, ret):
+		if self.wordsize >= 32:
+			words = [riffa.pack(x) for x in zip(*[ret[i::self.wordsize//32] for i in range(self.wordsize//32)])]
+		else:
+			words = []
+			mask = 1
+			for i in range(self.wordsize):
+				mask = mask | (1 << i)
+			for i in range(len(ret)):
+				for j in range(32//self.wordsize):
+					words.append((ret[i] >> j*self.wordsize) & mask)
+		print("Modified:")
+		num_modified = 0
+		for i in range(len(words)):
+			if words[i] != self.read_mem(addr+i*(self.wordsize//8)):
+				num_modified += 1
+				self.modified[addr+i*(self.wordsize//8)] = words[i]
+				if num_modified < 10:
+					print(hex(addr+i*(self.wordsize//8)) + ": " + hex(words[i]))
+		if num_modified >= 10:
+			print("and more... " + str(num_modified) + " total.")
+
 	def send_flush_command(self, selfp):
 		self.flushack = 0
 		yield from riffa.channel_write(selfp.simulator, self.cmd_tx, [0xF1005])
@@ -117,13 +169,75 @@ class TBMemory(Module):
 	def send_invalidate_command(self, selfp):
 		yield from riffa.channel_write(selfp.simulator, self.cmd_tx, [0xC105E])
 
+	def send_counters_command(self, selfp):
+		self.counters = None
+		yield from riffa.channel_write(selfp.simulator, self.cmd_tx, [0x57A75])
+		while self.counters is None:
+			yield
+
+	def send_flush_range_command(self, selfp, addr, length):
+		self.flushack = 0
+		yield from riffa.channel_write(selfp.simulator, self.cmd_tx, [0xAF1005, length, addr & 0xFFFFFFFF, addr >> 32])
+		while self.flushack == 0:
+			yield
+		self.flushack = 0
+
+	def send_invalidate_range_command(self, selfp, addr, length):
+		yield from riffa.channel_write(selfp.simulator, self.cmd_tx, [0xAC105E, length, addr & 0xFFFFFFFF, addr >> 32])
+
+	def send_pin_range_command(self, selfp, addr, length):
+		yield from riffa.channel_write(selfp.simulator, self.cmd_tx, [0xAB10C, length, addr & 0xFFFFFFFF, addr >> 32])
+
+	def send_unpin_range_command(self, selfp, addr, length):
+		yield from riffa.channel_write(selfp.simulator, self.cmd_tx, [0xAF2EE, length, addr & 0xFFFFFFFF, addr >> 32])
+
+	def send_push_command(self, selfp, addr):
+		print("Pushing page " + hex(addr))
+		yield from riffa.channel_write(selfp.simulator, self.cmd_tx, [0x9054, self.pagesize, addr & 0xFFFFFFFF, addr >> 32])
+		yield from riffa.channel_write(selfp.simulator, self.data_tx, self.page_data(addr, self.pagesize//4))
+
+
+class TBClient(Module):
+	def __init__(self, tb, port, base):
+		# random requests on one port of the cache to pages of its own starting at base, checked by the helpers of tb
+		self.tb = tb
+		self.base = base
+		self.finished = False
+		for name, *_ in port.layout:
+			setattr(self, name, getattr(port, name))
+
+	def gen_simulation(self, selfp):
+		generate_data = generate_data_fn(self.tb.wordsize)
+		for i in range(16):
+			addr = self.base + random.randrange(3)*self.tb.pagesize + 4*random.randrange(self.tb.pagesize//4)
+			if random.randint(0, 1):
+				yield from self.tb.write(selfp, addr, generate_data(addr) + 1)
+				print("Port at " + hex(self.base) + " wrote data " + hex(generate_data(addr) + 1) + " to address " + hex(addr))
+			else:
+				data = yield from self.tb.read(selfp, addr)
+				print("Port at " + hex(self.base) + " read data " + hex(data) + " from address " + hex(addr))
+		self.finished = True
 
 class TB(Module):
-	def __init__(self):
+	def __init__(self, npagesincache=4, pagesize=4096, nways=None, sectorsize=None, trace_file=None, commands=False, model=True, **kwargs):
+		# trace_file: write the requests to a trace file for cachesim
+		# model: check the bytes transferred against cachesim, which models the blocking cache without prefetching
+		# commands: run the command channel tests after the random requests
+		# kwargs: further options of VirtmemWrapper
+		self.trace_file = trace_file
+		self.commands = commands
+		self.model = model
+		self.options = kwargs
+		self.trace = []
+		self.written = {}
+		self.retries = 0
 		self.c_pci_data_width = c_pci_data_width = 128
 		self.ptrsize = 64
 		self.wordsize = 32
-		self.pagesize = 4096
+		self.npagesincache = npagesincache
+		self.pagesize = pagesize
+		self.nways = nways
+		self.sectorsize = sectorsize
 		num_chnls = 2
 		combined_interface_tx = riffa.Interface(data_width=c_pci_data_width, num_chnls=num_chnls)
 		combined_interface_rx = riffa.Interface(data_width=c_pci_data_width, num_chnls=num_chnls)
@@ -133,18 +247,369 @@ class TB(Module):
 			c_pci_data_width=c_pci_data_width, 
 			wordsize=self.wordsize, 
 			ptrsize=self.ptrsize, 
-			drive_clocks=False)
+			drive_clocks=False,
+			npagesincache=npagesincache,
+			pagesize=pagesize,
+			nways=nways,
+			sectorsize=sectorsize,
+			**kwargs)
+
+		# one client per port when the cache has several
+		self.clients = [TBClient(self, port, 0x1000000*(i + 1)) for i, port in enumerate(self.dut.virtmem.ports)]
+		self.submodules += self.clients
 
 		self.submodules.channelsplitter = riffa.ChannelSplitter(combined_interface_tx, combined_interface_rx)
 		tx0, rx0 = self.channelsplitter.get_channel(0)
 		tx1, rx1 = self.channelsplitter.get_channel(1)
 
+		init_fn = generate_data_fn(self.wordsize)
+		if kwargs.get("zero_pages"):
+			# the pages at 0x800000 hold zeros only
+			def init_fn(addr, generate_data=init_fn):
+				return 0 if addr >> 16 == 0x80 else generate_data(addr)
 		self.submodules.tbmem = TBMemory(tx0, rx0, tx1, rx1, 
 			c_pci_data_width=c_pci_data_width, 
 			wordsize=self.wordsize, 
 			ptrsize=self.ptrsize,
-			init_fn=generate_data_fn(self.wordsize))
+			pagesize=pagesize,
+			init_fn=init_fn,
+			zero_pages=kwargs.get("zero_pages", False))
+
+	# the data of addr the cache has to return, written words are only in host memory after a flush
+	def expected(self, addr):
+		return self.written.get(addr, self.tbmem.read_mem(addr))
+
+	# single word requests on port (selfp of the Virtmem or of one of its ports), reissued as long as they end with a miss
+	def read(self, port, addr, pin=0):
+		data = None
+		while data is None:
+			port.virt_addr = addr
+			port.num_words = 1
+			port.write_enable = 0
+			port.pin = pin
+			port.req = 1
+			yield
+			port.req = 0
+			while not port.done:
+				if port.data_valid:
+					data = port.data_read
+				yield
+			if port.data_valid:
+				data = port.data_read
+			if port.miss:
+				self.retries += 1
+				data = None
+		port.pin = 0
+		if data != self.expected(addr):
+			print("Read wrong data " + hex(data) + " from address " + hex(addr))
+		assert(data == self.expected(addr))
+		return data
+
+	def write(self, port, addr, data):
+		acked = False
+		while not acked:
+			port.virt_addr = addr
+			port.num_words = 1
+			port.write_enable = 1
+			port.data_write = data
+			port.req = 1
+			yield
+			port.req = 0
+			while not port.done:
+				acked = acked or port.write_ack
+				yield
+			acked = (acked or port.write_ack) and not port.miss
+			self.retries += port.miss
+		port.write_enable = 0
+		self.written[addr] = data
+
+	# after a flush host memory has to hold exactly the words written
+	def check_host_memory(self):
+		for addr in self.tbmem.modified:
+			assert(addr in self.written)
+		for addr, data in self.written.items():
+			if self.tbmem.read_mem(addr) != data:
+				print("Host memory has " + hex(self.tbmem.read_mem(addr)) + " instead of " + hex(data) + " at " + hex(addr))
+			assert(self.tbmem.read_mem(addr) == data)
+		print("Host memory holds the " + str(len(self.written)) + " words written")
+
+	# bursts are reissued if they miss at their first word
+	def read_burst(self, port, addr, num_words):
+		words_recvd = 0
+		while words_recvd < num_words:
+			port.virt_addr = addr
+			port.num_words = num_words
+			port.write_enable = 0
+			port.req = 1
+			yield
+			port.req = 0
+			while True:
+				if port.data_valid:
+					data = port.data_read
+					print("Read " + hex(data) + " from address " + hex(addr + 4*words_recvd))
+					assert(data == self.expected(addr + 4*words_recvd))
+					words_recvd += 1
+				if port.done:
+					break
+				yield
+			yield
+
+	def write_burst(self, port, addr, data):
+		words_sent = 0
+		while words_sent < len(data):
+			port.virt_addr = addr
+			port.num_words = len(data)
+			port.write_enable = 1
+			port.data_write = data[words_sent]
+			port.req = 1
+			yield
+			port.req = 0
+			while True:
+				if port.write_ack:
+					print("Wrote " + hex(data[words_sent]) + " to address " + hex(addr + 4*words_sent))
+					self.written[addr + 4*words_sent] = data[words_sent]
+					words_sent += 1
+				port.data_write = data[words_sent] if words_sent < len(data) else 0
+				if port.done:
+					break
+				yield
+			port.write_enable = 0
+			yield
+
+	# reads one word of npagesincache pages not accessed before, evicting every page that is not pinned
+	def stream(self, selfp):
+		for i in range(self.npagesincache):
+			yield from self.read(selfp.dut.virtmem, self.stream_page)
+			self.stream_page += self.pagesize
+
+	def expect_fetches(self, n, what):
+		print(what + ": " + str(self.tbmem.fetches) + " fetches")
+		assert(self.tbmem.fetches == n)
+
+	# command channel tests, the resulting cache state is checked by counting the fetches the host sees
+	def test_commands(self, selfp):
+		a, b = 0x100000, 0x101000
+		yield from self.tbmem.send_invalidate_command(selfp)
+		yield 10
+
+		# range flush: the written word reaches the host
+		yield from self.write(selfp.dut.virtmem, a + 8, 0x1234)
+		yield from self.tbmem.send_flush_range_command(selfp, a, self.pagesize)
+		assert(self.tbmem.read_mem(a + 8) == 0x1234)
+		print("Range flush wrote back " + hex(a + 8))
+
+		# range invalidate: the page is fetched again
+		yield from self.read(selfp.dut.virtmem, b)
+		fetches = self.tbmem.fetches
+		yield from self.read(selfp.dut.virtmem, b + 4)
+		self.expect_fetches(fetches, "Hit before invalidation")
+		yield from self.tbmem.send_invalidate_range_command(selfp, b, self.pagesize)
+		yield 10
+		yield from self.read(selfp.dut.virtmem, b)
+		self.expect_fetches(fetches + 1, "Miss after invalidation")
+		if self.options.get("pinning"):
+			yield from self.test_pinning(selfp)
+		if self.options.get("counters"):
+			yield from self.test_counters(selfp)
+		if self.options.get("push"):
+			yield from self.test_push(selfp)
+		print("Command channel tests passed")
+
+	def test_pinning(self, selfp):
+		c = 0x102000
+		self.stream_page = 0x200000
+
+		# pinned by the kernel: the page survives a stream of other pages until unpinned by the host
+		yield from self.read(selfp.dut.virtmem, c, pin=1)
+		yield from self.stream(selfp)
+		fetches = self.tbmem.fetches
+		yield from self.read(selfp.dut.virtmem, c)
+		self.expect_fetches(fetches, "Kernel pinned page kept")
+		yield from self.tbmem.send_unpin_range_command(selfp, c, self.pagesize)
+		yield 10
+		yield from self.stream(selfp)
+		fetches = self.tbmem.fetches
+		yield from self.read(selfp.dut.virtmem, c)
+		self.expect_fetches(fetches + 1, "Host unpinned page evicted")
+
+		# pinned by the host: the page survives until the kernel unpins all pages
+		yield from self.tbmem.send_pin_range_command(selfp, c, self.pagesize)
+		yield 10
+		yield from self.stream(selfp)
+		fetches = self.tbmem.fetches
+		yield from self.read(selfp.dut.virtmem, c)
+		self.expect_fetches(fetches, "Host pinned page kept")
+		selfp.dut.virtmem.unpin_all = 1
+		yield
+		selfp.dut.virtmem.unpin_all = 0
+		yield from self.stream(selfp)
+		fetches = self.tbmem.fetches
+		yield from self.read(selfp.dut.virtmem, c)
+		self.expect_fetches(fetches + 1, "Kernel unpinned page evicted")
+
+	# the page transferrer counters (the last five) match the transfers the host saw
+	def test_counters(self, selfp):
+		yield from self.tbmem.send_counters_command(selfp)
+		assert(len(self.tbmem.counters) == len(self.dut.virtmem.counters))
+		fetches, writebacks, words_received, words_sent, host_wait_cycles = self.tbmem.counters[-5:]
+		assert(fetches == self.tbmem.fetches)
+		assert(words_received == self.tbmem.fetch_bytes//4)
+		assert(words_sent == self.tbmem.writeback_bytes//4)
+		# misses, the blocking cache fetches once per miss
+		assert(self.tbmem.counters[3] == fetches)
+		print("Counters match the transfers")
+
+	# pushed pages fill free slots and are served without a fetch
+	def test_push(self, selfp):
+		pages = [0x300000, 0x301000, 0x302000]
+		yield from self.tbmem.send_invalidate_command(selfp)
+		yield 10
+		for p in pages:
+			yield from self.tbmem.send_push_command(selfp, p)
+			yield 10
+		fetches = self.tbmem.fetches
+		for p in pages:
+			yield from self.read(selfp.dut.virtmem, p + 0x40)
+		self.expect_fetches(fetches, "Pushed pages hit")
+		# pushing a resident page again drops it, the written word stays
+		yield from self.write(selfp.dut.virtmem, pages[0], 0x9054)
+		yield from self.tbmem.send_push_command(selfp, pages[0])
+		yield 10
+		yield from self.read(selfp.dut.virtmem, pages[0])
+		for p in pages:
+			yield from self.read(selfp.dut.virtmem, p)
+		self.expect_fetches(fetches, "Resident page not replaced by push")
+		yield from self.tbmem.send_flush_command(selfp)
+		self.check_host_memory()
+
+	# a walk over every stride'th page (on stream 0) is served from prefetched pages
+	def test_prefetch(self, selfp, stride):
+		for i in range(8):
+			yield from self.read(selfp.dut.virtmem, 0x400000 + i*stride*self.pagesize + 4*i)
+		yield 10
+		print("Prefetches: {} issued, {} useful".format(selfp.dut.virtmem.prefetch_issued, selfp.dut.virtmem.prefetch_useful))
+		assert(selfp.dut.virtmem.prefetch_useful > 0)
+
+	# writes covering a whole page (or sector) or raising write_only allocate it without a fetch
+	def test_write_nofetch(self, selfp):
+		a, b = 0x500000, 0x501000
+		fetches = self.tbmem.fetches
+		yield from self.write_burst(selfp.dut.virtmem, a, [0x5000 + i for i in range((self.sectorsize or self.pagesize)//4)])
+		yield from self.read(selfp.dut.virtmem, a + 0x40)
+		self.expect_fetches(fetches, "Overwritten page allocated")
+		yield from self.tbmem.send_flush_command(selfp)
+		self.check_host_memory()
+		# the other words of a write_only page are undefined, only the written one is read back
+		selfp.dut.virtmem.write_only = 1
+		yield from self.write(selfp.dut.virtmem, b + 8, 0x1234)
+		selfp.dut.virtmem.write_only = 0
+		yield from self.read(selfp.dut.virtmem, b + 8)
+		self.expect_fetches(fetches, "Write only page allocated")
+
+	# while idle, dirty pages above the watermark are written back and stay resident
+	def test_clean(self, selfp, watermark):
+		pages = [0x600000 + i*self.pagesize for i in range(self.npagesincache)]
+		yield from self.tbmem.send_flush_command(selfp)
+		writeback_bytes = self.tbmem.writeback_bytes
+		for p in pages:
+			yield from self.write(selfp.dut.virtmem, p + 4, 0xC1EA)
+		fetches = self.tbmem.fetches
+		yield 2000
+		print("Cleaned {} bytes while idle".format(self.tbmem.writeback_bytes - writeback_bytes))
+		assert(self.tbmem.writeback_bytes - writeback_bytes >= (len(pages) - watermark)*self.pagesize)
+		for p in pages:
+			yield from self.read(selfp.dut.virtmem, p + 4)
+		self.expect_fetches(fetches, "Cleaned pages hit")
+		yield from self.tbmem.send_flush_command(selfp)
+		self.check_host_memory()
+
+	# non-blocking: misses to new pages are all issued before the first one is reissued, so their fetches overlap
+	def test_misses(self, selfp):
+		pages = [0x700000 + i*self.pagesize for i in range(self.options["nmshr"])]
+		fetches = self.tbmem.fetches
+		for p in pages:
+			selfp.dut.virtmem.virt_addr = p
+			selfp.dut.virtmem.num_words = 1
+			selfp.dut.virtmem.write_enable = 0
+			selfp.dut.virtmem.req = 1
+			yield
+			selfp.dut.virtmem.req = 0
+			while not selfp.dut.virtmem.done:
+				yield
+			assert(selfp.dut.virtmem.miss)
+		for p in pages:
+			yield from self.read(selfp.dut.virtmem, p + 0x10)
+		self.expect_fetches(fetches + len(pages), "Outstanding misses served")
+
+	# all zero pages are fetched as a single word and written back with a zero writeback command only
+	def test_zero_pages(self, selfp):
+		a = 0x800000
+		fetch_bytes = self.tbmem.fetch_bytes
+		yield from self.read(selfp.dut.virtmem, a + 0x20)
+		assert(self.tbmem.fetch_bytes - fetch_bytes < self.pagesize)
+		yield from self.write(selfp.dut.virtmem, a + 0x24, 0)
+		writeback_bytes, zero_writebacks = self.tbmem.writeback_bytes, self.tbmem.zero_writebacks
+		yield from self.tbmem.send_flush_command(selfp)
+		print("Zero page fetched with {} bytes, {} zero writebacks".format(self.tbmem.fetch_bytes - fetch_bytes, self.tbmem.zero_writebacks - zero_writebacks))
+		assert(self.tbmem.zero_writebacks == zero_writebacks + 1 and self.tbmem.writeback_bytes == writeback_bytes)
+		self.check_host_memory()
+
+	# scratchpad loads and stores of page ranges by the kernel
+	def sp_command(self, vm, name, addr, num_words, sp_adr):
+		vm.virt_addr = addr
+		vm.num_words = num_words
+		vm.sp_adr = sp_adr
+		setattr(vm, name, 1)
+		yield
+		setattr(vm, name, 0)
+		while not vm.done:
+			yield
 
+	# direct scratchpad accesses are held for a cycle and then until sp_ack
+	def sp_read(self, vm, sp_adr):
+		vm.sp_adr = sp_adr
+		vm.sp_re = 1
+		yield
+		while not vm.sp_ack:
+			yield
+		yield
+		vm.sp_re = 0
+		assert(vm.sp_valid)
+		return vm.sp_dat_r
+
+	def sp_write(self, vm, sp_adr, data):
+		vm.sp_adr = sp_adr
+		vm.sp_dat_w = data
+		vm.sp_we = 1
+		yield
+		while not vm.sp_ack:
+			yield
+		yield
+		vm.sp_we = 0
+
+	# a load sees the words written through the cache, cached reads see the words stored from the scratchpad
+	def test_scratchpad(self, selfp):
+		vm = selfp.dut.virtmem
+		a = 0x900000
+		sp_page = self.pagesize*8//self.wordsize
+		yield from self.write(vm, a + self.pagesize + 0x10, 0x5C10)
+		yield from self.sp_command(vm, "sp_load", a, 2*self.pagesize//4, sp_page)
+		data = yield from self.sp_read(vm, 2*sp_page + 0x10//4)
+		assert(data == 0x5C10)
+		data = yield from self.sp_read(vm, sp_page + 0x30//4)
+		assert(data == self.expected(a + 0x30))
+		yield from self.sp_write(vm, sp_page + 0x20//4, 0x5C20)
+		yield from self.sp_write(vm, 2*sp_page + 0x24//4, 0x5C24)
+		self.written[a + 0x20] = 0x5C20
+		self.written[a + self.pagesize + 0x24] = 0x5C24
+		yield from self.sp_command(vm, "sp_store", a, 2*self.pagesize//4, sp_page)
+		fetches = self.tbmem.fetches
+		for addr in a + 0x20, a + self.pagesize + 0x24, a + self.pagesize + 0x10:
+			yield from self.read(vm, addr)
+		self.expect_fetches(fetches + 2, "Stored pages fetched again")
+		yield from self.tbmem.send_flush_command(selfp)
+		self.check_host_memory()
+		print("Scratchpad loads and stores agree with the cache")
 
 	def generate_random_address(self):
 		pages = [0x604000, 0x597a000, 0x456000, 0xfffe000, 0x7868000, 0x222000, 0xaa45000]
@@ -157,23 +622,17 @@ class TB(Module):
 			yield (self.generate_random_address(), random.randint(0,1))
 
 
-	def gen_simulation(self, selfp):
+	# random single word requests, then a read and a write burst crossing a page boundary
+	def test_requests(self, selfp):
 		generate_data = generate_data_fn(self.wordsize)
 		for addr, we in self.generate_random_transactions(24):
-			selfp.dut.virtmem.virt_addr = addr
-			selfp.dut.virtmem.num_words = 1
-			selfp.dut.virtmem.req = 1
-			selfp.dut.virtmem.write_enable = we
-			if we:
-				selfp.dut.virtmem.data_write = generate_data(addr) + 1
-			yield
-			selfp.dut.virtmem.req = 0
-			while not selfp.dut.virtmem.done:
-				yield
+			self.trace.append((addr, 1, we))
 			if we:
+				yield from self.write(selfp.dut.virtmem, addr, generate_data(addr) + 1)
 				print("Wrote data " + hex(generate_data(addr) + 1) + " to address " + hex(addr))
 			else:
-				print("Read data " + hex(selfp.dut.virtmem.data_read) + " from address " + hex(addr))
+				data = yield from self.read(selfp.dut.virtmem, addr)
+				print("Read data " + hex(data) + " from address " + hex(addr))
 		selfp.dut.virtmem.virt_addr = 0
 		selfp.dut.virtmem.req = 0
 		selfp.dut.virtmem.data_write = 0
@@ -181,63 +640,77 @@ class TB(Module):
 		yield
 		num_words = 8
 		addr = 0x456FF0
-		selfp.dut.virtmem.virt_addr = addr
-		selfp.dut.virtmem.num_words = num_words
-		selfp.dut.virtmem.req = 1
+		self.trace.append((addr, num_words, 0))
 		print("Requesting read burst of " + str(num_words) + " words starting from address " + hex(addr))
-		internal_address = addr
-		words_recvd = 0
-		while words_recvd < num_words:
-			yield
-			if selfp.dut.virtmem.data_valid:
-				words_recvd += 1
-				print("Read " + hex(selfp.dut.virtmem.data_read) + " from address " + hex(internal_address))
-				internal_address = selfp.dut.virtmem.virt_addr_internal
-
-		selfp.dut.virtmem.virt_addr = 0
-		selfp.dut.virtmem.req = 0
-		selfp.dut.virtmem.data_write = 0
-		selfp.dut.virtmem.write_enable = 0
+		yield from self.read_burst(selfp.dut.virtmem, addr, num_words)
 
 		yield
 
 		num_words = 8
 		addr = 0x456FF0
-		selfp.dut.virtmem.virt_addr = addr
-		selfp.dut.virtmem.num_words = num_words
-		selfp.dut.virtmem.req = 1
-		selfp.dut.virtmem.write_enable = 1
-		selfp.dut.virtmem.data_write = 0xBAE
-
+		self.trace.append((addr, num_words, 1))
 		print("Requesting write burst of " + str(num_words) + " words starting from address " + hex(addr))
-		internal_address = addr
-		words_sent = 0
-		while words_sent < num_words:
-			selfp.dut.virtmem.data_write = words_sent
-			yield
-			if selfp.dut.virtmem.write_ack:
-				words_sent += 1
-				internal_address = selfp.dut.virtmem.virt_addr_internal
-				print("Wrote " + hex(selfp.dut.virtmem.data_write) + " to address " + hex(internal_address))
-
+		yield from self.write_burst(selfp.dut.virtmem, addr, list(range(num_words)))
 
-		selfp.dut.virtmem.virt_addr = 0
-		selfp.dut.virtmem.req = 0
-		selfp.dut.virtmem.data_write = 0
-		selfp.dut.virtmem.write_enable = 0
+	def gen_simulation(self, selfp):
+		if self.clients:
+			# the ports are served concurrently by their clients
+			while not all(client.finished for client in self.clients):
+				yield
+		else:
+			yield from self.test_requests(selfp)
 
 		# selfp.dut.virtmem.flush_all = 1
 		# yield 2
 		# while not selfp.dut.virtmem.done:
 		# 	yield
 
+		# bytes of dirty victims written back on misses
+		evicted_bytes = self.tbmem.writeback_bytes
 		yield from riffa.channel_write(selfp.simulator, self.tbmem.cmd_tx, [0xF1005])
 		while not self.tbmem.flushack:
 			yield
 
 		yield 20
+		self.check_host_memory()
 
 		print("Simulation took " + str(selfp.simulator.cycle_counter) + " cycles.")
+		import cachesim
+		if self.trace_file is not None:
+			cachesim.save_trace(self.trace_file, self.trace)
+		# the trace model has to transfer as much as the cache did
+		if self.model:
+			model = cachesim.CacheModel(npagesincache=self.npagesincache - self.options.get("scratchpad_pages", 0), pagesize=self.pagesize, nways=self.nways, sectorsize=self.sectorsize, dirtysize=self.options.get("dirtysize"))
+			model.run(*cachesim.expand_requests(*zip(*self.trace), wordsize=self.wordsize))
+			stats = model.flush()
+			print("Fetched {} bytes (model {}), wrote back {} bytes (model {})".format(self.tbmem.fetch_bytes, stats["fetch_bytes"], self.tbmem.writeback_bytes, stats["writeback_bytes"]))
+			assert(self.tbmem.fetch_bytes == stats["fetch_bytes"] and self.tbmem.writeback_bytes == stats["writeback_bytes"])
+		if self.options.get("coalesce_flush"):
+			print("Coalesced flushes: " + str(self.tbmem.coalesced_flushes))
+			assert(self.tbmem.coalesced_flushes == 1)
+		if self.options.get("victim_buffer"):
+			# the victims went out through the buffer while the misses were fetched
+			print("Wrote back {} bytes of victims before the flush".format(evicted_bytes))
+			assert(evicted_bytes > 0)
+		if self.options.get("nmshr"):
+			# non-blocking: requests that miss at their first word end with miss and are reissued
+			print("Reissued " + str(self.retries) + " requests")
+			assert(self.retries > 0)
+			yield from self.test_misses(selfp)
+		if self.options.get("prefetch_depth"):
+			yield from self.test_prefetch(selfp, 1)
+		if self.options.get("nstreams"):
+			yield from self.test_prefetch(selfp, 2)
+		if self.options.get("write_nofetch"):
+			yield from self.test_write_nofetch(selfp)
+		if self.options.get("clean_watermark") is not None:
+			yield from self.test_clean(selfp, self.options["clean_watermark"])
+		if self.options.get("zero_pages"):
+			yield from self.test_zero_pages(selfp)
+		if self.options.get("scratchpad_pages"):
+			yield from self.test_scratchpad(selfp)
+		if self.commands:
+			yield from self.test_commands(selfp)
 		# for i in range(1024):
 		# 	a, b, c, d = riffa.unpack(selfp.simulator.rd(self.dut.virtmem.mem, i), 4)
 		# 	print("{0:04x}: {1:08x} {2:08x} {3:08x} {4:08x}".format(i*16, a, b, c, d))
@@ -246,5 +719,56 @@ class TB(Module):
 
 
 if __name__ == "__main__":
-	tb = TB()
+	# whole pages, then sectors (the model has to agree on the bytes written back for both)
+	for sectorsize in None, 1024:
+		tb = TB(sectorsize=sectorsize)
+		run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# dirty blocks, only the written ranges of a page are sent back
+	for sectorsize, dirtysize in (None, 512), (1024, 256):
+		tb = TB(sectorsize=sectorsize, dirtysize=dirtysize)
+		run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# range flush and invalidate, pinning, counters and page push over the command channel
+	tb = TB(commands=True, pinning=True, counters=True, push=True)
+	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=100000)
+	# set associative, the random pages conflict in one set of 2 ways
+	for nways in 1, 2:
+		tb = TB(npagesincache=8, nways=nways)
+		run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# tags in block RAM, for whole pages and sectors
+	for sectorsize in None, 1024:
+		tb = TB(npagesincache=8, nways=2, sectorsize=sectorsize, tag_bram=True)
+		run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# two ports requesting at the same time, for both arbitration schemes (the model has no ports)
+	for arbitration in "roundrobin", "priority":
+		tb = TB(nports=2, arbitration=arbitration, model=False)
+		run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# write misses that overwrite the page or sector are not fetched (the model always fetches)
+	for sectorsize in None, 1024:
+		tb = TB(sectorsize=sectorsize, write_nofetch=True, model=False)
+		run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# the final flush sends all dirty pages in one transaction, with a header of one beat and of two
+	for npagesincache in 2, 4:
+		tb = TB(npagesincache=npagesincache, coalesce_flush=True)
+		run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# all zero pages are not sent over the channel
+	tb = TB(zero_pages=True)
+	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# half of the block RAM is a scratchpad, loaded from and stored to ranges the cache also holds
+	tb = TB(npagesincache=8, scratchpad_pages=4)
+	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# dirty victims are written back from the victim buffer
+	tb = TB(victim_buffer=True)
+	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# background cleaning of dirty pages (when it runs depends on idle cycles the model does not know)
+	tb = TB(clean_watermark=1, model=False)
+	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# non-blocking with MSHRs, with one and with two fetches in flight
+	for nfetches in 1, 2:
+		tb = TB(nmshr=2, nfetches=nfetches)
+		run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# sequential prefetching (the model does not prefetch)
+	tb = TB(prefetch_depth=2, model=False)
+	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)
+	# stride prefetching on one stream
+	tb = TB(nstreams=1, model=False)
 	run_simulation(tb, vcd_name="tb.vcd", keep_files=True, ncycles=30000)